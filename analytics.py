@@ -0,0 +1,185 @@
+from typing import (
+    AsyncIterator,
+    Dict,
+    Optional,
+    Tuple,
+)
+
+import asyncio
+import datetime
+import os
+import shutil
+import socket
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
+import asqlite
+from fastapi import Response
+
+from database import DATABASE_BACKEND, DB_PATH, SQLiteDatabase, logger, online_backup, open_db
+from logger import Logger
+
+ANALYTICS_MODE = os.getenv("ANALYTICS_MODE", "live")
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", "analytics")
+ANALYTICS_REFRESH_INTERVAL = float(os.getenv("ANALYTICS_REFRESH_INTERVAL", "60"))
+ANALYTICS_BACKUP_PAGES = int(os.getenv("ANALYTICS_BACKUP_PAGES", "1024"))
+ANALYTICS_BACKUP_PAUSE = float(os.getenv("ANALYTICS_BACKUP_PAUSE", "0.005"))
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class AnalyticsDatabase(SQLiteDatabase):
+    """A `SQLiteDatabase` over a snapshot file. The connection is `query_only`, so nothing can write to a snapshot."""
+
+    def __init__(self, logger: Logger, path: str):
+        super().__init__(logger)
+        self.db_name = path
+
+    async def __aenter__(self):
+        self.conn = await asqlite.connect(self.db_name, init=lambda conn: conn.execute("PRAGMA query_only = ON"))
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        if self.conn:
+            await self.conn.close()
+
+
+class AnalyticsSnapshot:
+    """
+    Keeps a read-only copy of the database for admin reports, so their long scans never share a connection or a file
+    with checkout.
+
+    Every refresh copies the live database into a new file with `online_backup`, a few pages per step with a short pause
+    in between. The backup API has no way to copy only the changed pages, so a refresh is always a full copy, which is
+    why refreshes are skipped entirely while `PRAGMA data_version` says nothing was committed.
+
+    Each worker process keeps its snapshots in its own directory under `ANALYTICS_DIR`, named after the host and the
+    process id, and only ever touches that one. A process that died leaves its directory behind until a process with
+    the same host and id starts.
+    """
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self.path: Optional[str] = None
+        # The live database had no commits the snapshot is missing as of this time.
+        self.fresh_as_of: Optional[datetime.datetime] = None
+        self.readers: Dict[str, int] = {}
+        self.dir = os.path.join(ANALYTICS_DIR, f"{socket.gethostname()}-{os.getpid()}")
+        self._generation = 0
+        self._source: Optional[sqlite3.Connection] = None
+        self._data_version: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # Whatever is here was left by an earlier process with this host and pid, which is gone now.
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(self.dir, exist_ok=True)
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._source:
+            self._source.close()
+            self._source = None
+        self.path = None
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.logger.error(f"Analytics snapshot refresh failed: {e}")
+            await asyncio.sleep(ANALYTICS_REFRESH_INTERVAL)
+
+    async def refresh(self):
+        checked_at = _now()
+        result = await asyncio.to_thread(self._backup)
+        if result is None:
+            self.fresh_as_of = checked_at
+            return
+
+        path, taken_at, duration = result
+        old_path, self.path, self.fresh_as_of = self.path, path, taken_at
+        self.readers.setdefault(path, 0)
+        if old_path:
+            self._cleanup(old_path)
+        self.logger.info(f"Analytics snapshot {path} taken in {duration:.2f}s")
+
+    def _backup(self) -> Optional[Tuple[str, datetime.datetime, float]]:
+        """Runs in a worker thread. Returns None when the live database hasn't changed since the last snapshot."""
+        if self._source is None:
+            self._source = sqlite3.connect(
+                os.getenv("DATABASE_NAME", DB_PATH), isolation_level=None, check_same_thread=False
+            )
+
+        version = self._source.execute("PRAGMA data_version").fetchone()[0]
+        if self.path is not None and version == self._data_version:
+            return None
+
+        self._generation += 1
+        path = os.path.join(self.dir, f"snapshot-{self._generation}.db")
+        start = time.perf_counter()
+        taken_at = online_backup(self._source, path, ANALYTICS_BACKUP_PAGES, ANALYTICS_BACKUP_PAUSE)
+
+        self._data_version = version
+        return path, taken_at, time.perf_counter() - start
+
+    def _cleanup(self, path: str):
+        """Deletes a snapshot file once it is no longer current and nobody is reading from it."""
+        if path == self.path or self.readers.get(path):
+            return
+        self.readers.pop(path, None)
+        for leftover in (path, f"{path}-wal", f"{path}-shm"):
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+
+    def staleness(self) -> float:
+        if self.fresh_as_of is None:
+            return 0.0
+        return (_now() - self.fresh_as_of).total_seconds()
+
+    @asynccontextmanager
+    async def open(self) -> AsyncIterator[AnalyticsDatabase]:
+        path = self.path
+        assert path is not None
+        self.readers[path] += 1
+        try:
+            async with AnalyticsDatabase(self.logger, path) as db:
+                yield db
+        finally:
+            self.readers[path] -= 1
+            self._cleanup(path)
+
+
+analytics_snapshot: Optional[AnalyticsSnapshot] = None
+
+if ANALYTICS_MODE == "snapshot":
+    if DATABASE_BACKEND != "sqlite":
+        # Postgres readers never block its writers anyway, point reports at a read replica instead if needed.
+        Logger("analytics").warn("ANALYTICS_MODE=snapshot needs the sqlite backend, reports will read the live database")
+    else:
+        analytics_snapshot = AnalyticsSnapshot(Logger("analytics"))
+
+
+# Admin reports depend on this instead of `get_db`. With a snapshot it reads from the snapshot,
+# otherwise (or until the first snapshot exists) it falls back to the live database.
+async def get_report_db(response: Response):
+    if analytics_snapshot is None or analytics_snapshot.path is None:
+        response.headers["X-Snapshot-Age"] = "0"
+        response.headers["X-Snapshot-As-Of"] = _now().isoformat()
+        async with open_db(logger=logger) as db:
+            yield db
+        return
+
+    response.headers["X-Snapshot-Age"] = f"{analytics_snapshot.staleness():.3f}"
+    response.headers["X-Snapshot-As-Of"] = analytics_snapshot.fresh_as_of.isoformat()  # type: ignore
+    async with analytics_snapshot.open() as db:
+        yield db
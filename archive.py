@@ -0,0 +1,83 @@
+from typing import (
+    Any,
+    Dict,
+    Optional,
+)
+
+import asyncio
+import datetime
+import os
+import time
+
+from database import open_db
+from logger import Logger
+
+# Orders older than this many days get moved to the archive database. Unset, the background archiver doesn't run.
+ORDER_ARCHIVE_AGE_DAYS = os.getenv("ORDER_ARCHIVE_AGE_DAYS")
+ORDER_ARCHIVE_INTERVAL = float(os.getenv("ORDER_ARCHIVE_INTERVAL", "3600"))
+ORDER_ARCHIVE_BATCH = int(os.getenv("ORDER_ARCHIVE_BATCH", "1000"))
+ORDER_ARCHIVE_PAUSE = float(os.getenv("ORDER_ARCHIVE_PAUSE", "0.05"))
+
+
+class OrderArchiver:
+    """
+    Moves old orders out of the hot `orders` table into the archive database, in small batches.
+
+    See `APIDatabase.copy_orders_to_archive` for why a pass is copy, move the cutoff, then delete: every step is
+    idempotent, so a pass that dies halfway is simply finished by the next one.
+    """
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self.lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if ORDER_ARCHIVE_AGE_DAYS:
+            self._task = asyncio.create_task(self._archive_loop(float(ORDER_ARCHIVE_AGE_DAYS)))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _archive_loop(self, age_days: float):
+        while True:
+            try:
+                await self.run(age_days)
+            except Exception as e:
+                self.logger.error(f"Order archiving failed: {e}")
+            await asyncio.sleep(ORDER_ARCHIVE_INTERVAL)
+
+    async def run(self, age_days: float) -> Dict[str, Any]:
+        """Archives every order older than `age_days` days and reports what it did."""
+        async with self.lock, open_db(self.logger) as db:
+            start = time.perf_counter()
+            before = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=age_days)).isoformat()
+            current = await db.get_meta("orders_archived_before")
+            # The cutoff never moves back, rows before the current one are already gone from the hot table.
+            if current is not None and current > before:
+                before = current
+
+            await db.attach_archive(create=True)
+
+            copied = 0
+            last_id = 0
+            while batch := await db.copy_orders_to_archive(before, last_id, ORDER_ARCHIVE_BATCH):
+                last_id, count = batch
+                copied += count
+                await asyncio.sleep(ORDER_ARCHIVE_PAUSE)
+
+            await db.advance_archive_cutoff(before)
+
+            deleted = 0
+            while count := await db.delete_archived_orders(ORDER_ARCHIVE_BATCH):
+                deleted += count
+                await asyncio.sleep(ORDER_ARCHIVE_PAUSE)
+
+            duration = time.perf_counter() - start
+            self.logger.info(f"Archived orders before {before}: {copied} copied, {deleted} deleted in {duration:.2f}s")
+            return {"archived_before": before, "copied": copied, "deleted": deleted, "duration": round(duration, 3)}
+
+
+order_archiver = OrderArchiver(Logger("archive"))
@@ -0,0 +1,103 @@
+"""
+Compares the SQL and columnar engines behind `/shop/list`.
+
+Usage: python bench_catalog.py [item_count ...]    (defaults to 100000 and 1000000)
+
+The benchmark builds a throwaway SQLite database per size, so it never touches `api_data.db`.
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from catalog import CatalogIndex, np
+from database import SQLiteDatabase, init_db
+from logger import Logger
+
+CATEGORIES = ["Clothing", "Shoes", "Accessories", "Sportswear", "Outerwear", "Kids"]
+BRANDS = ["Nike", "Adidas", "Puma", "Reebok", "Asics"]
+WORDS = ["T-shirt", "Jacket", "Shorts", "Hoodie", "Sneaker", "Cap", "Sock", "Trousers"]
+
+QUERIES = {
+    "default page": {},
+    "category + price sort": {"category": "Shoes", "sort_by": "price"},
+    "price range, desc": {"min_price": 500.0, "max_price": 900.0, "sort_by": "price", "sort_order": "desc"},
+    "search": {"search": "hoodie"},
+    # Next to nothing matches these, so no early stop: every candidate is looked at.
+    "rare search": {"search": "zzz"},
+    "wildcard search": {"search": "a_b%q"},
+    "deep page": {"offset": 5000, "limit": 100},
+}
+REPEATS = 20
+
+
+def populate(path: str, count: int):
+    conn = sqlite3.connect(path)
+    rng = random.Random(count)
+    rows = (
+        (
+            f"{rng.choice(WORDS)} {i}",
+            rng.choice(BRANDS),
+            f"{rng.choice(BRANDS)} {rng.choice(WORDS).lower()}",
+            rng.choice(CATEGORIES),
+            rng.randint(0, 50),
+            round(rng.uniform(100, 2000), 2),
+            "",
+            "",
+        )
+        for i in range(count)
+    )
+    conn.executemany(
+        "INSERT INTO items (name, brand, description, category, quantity, price, date_created, date_restocked) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    conn.commit()
+    conn.close()
+
+
+async def timed(fn, repeats: int = REPEATS) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        await fn()
+    return (time.perf_counter() - start) * 1000 / repeats
+
+
+async def bench(count: int):
+    logger = Logger("bench")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_NAME"] = os.path.join(tmp, "bench.db")
+        await init_db()
+        populate(os.environ["DATABASE_NAME"], count)
+
+        index = CatalogIndex(logger)
+        async with SQLiteDatabase(logger) as db:
+            start = time.perf_counter()
+            await index.search_items(db)
+            print(f"\n{count} items, index built in {(time.perf_counter() - start) * 1000:.0f} ms")
+            print(f"{'query':<24}{'sql ms':>10}{'columnar ms':>14}")
+
+            for name, kwargs in QUERIES.items():
+                sql = await timed(lambda: db.search_items(**kwargs))
+                columnar = await timed(lambda: index.search_items(db, **kwargs))
+                print(f"{name:<24}{sql:>10.2f}{columnar:>14.2f}")
+
+            async def write_then_read():
+                await db.update_item(random.randint(1, count), price=round(random.uniform(100, 2000), 2))
+                await index.search_items(db, sort_by="price")
+
+            print(f"{'update + re-read':<24}{'':>10}{await timed(write_then_read):>14.2f}")
+
+async def main():
+    if np is None:
+        sys.exit("The columnar engine needs numpy 2 or later installed.")
+    counts = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    for count in counts:
+        await bench(count)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,332 @@
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Set,
+)
+
+import asyncio
+import bisect
+import os
+import re
+
+try:
+    import numpy as np
+    from numpy.dtypes import StringDType  # numpy 2 and up
+except ImportError:  # The columnar engine is optional, without numpy /shop/list just stays on SQL.
+    np = None
+
+from changes import ItemChangeReader
+from database import APIDatabase, LIST_FIELDS
+from logger import Logger
+
+CATALOG_ENGINE = os.getenv("CATALOG_ENGINE", "sql")
+# Past this many changed items one full reload is cheaper than patching the sort orders.
+CATALOG_RELOAD_THRESHOLD = int(os.getenv("CATALOG_RELOAD_THRESHOLD", "5000"))
+# Items read per query while loading the index, each page is turned into rows on the event loop.
+CATALOG_LOAD_BATCH = 20000
+# Rows changed since the search text was joined after which it is joined again, until then they're checked one by one.
+SEARCH_REBUILD_ROWS = 1000
+# Rows of the sorted candidates a search checks one by one before it scans the whole search text instead.
+# A common term fills the page long before that.
+SEARCH_WALK_ROWS = 2000
+
+# Separates the names and descriptions in the search text. Searches can't match across it.
+_SEPARATOR = "\x00"
+# Strings handled per step of the work done in worker threads. One C-level call over a million of them would hold
+# the GIL, and so stall the event loop, for as long as it runs.
+_CHUNK = 20000
+
+
+def _search_pattern(search: str) -> "re.Pattern[str] | None":
+    """
+    What `LIKE '%search%'` matches (`%` any run of characters, `_` any one character), within one name or description
+    of the search text. None when that is everything.
+    """
+    search = search.lower().strip("%")
+    if not search:
+        return None
+    return re.compile("".join(
+        f"[^{_SEPARATOR}]*" if c == "%" else f"[^{_SEPARATOR}]" if c == "_" else re.escape(c) for c in search
+    ))
+
+
+def _join_search_text(names: List[str], descriptions: List[str]) -> tuple:
+    """
+    The lowercased names and descriptions of every row in one string, name then description, and where each of them
+    starts in it. One regex scan of that finds every row a search matches without a Python step per row.
+    """
+    parts = [part for pair in zip(names, descriptions) for part in pair]
+    lengths = np.fromiter((len(part) for part in parts), dtype=np.int64, count=len(parts))
+    starts = np.zeros(len(parts), dtype=np.int64)
+    np.cumsum(lengths[:-1] + 1, out=starts[1:])
+    text = _SEPARATOR.join([_SEPARATOR.join(parts[i:i + _CHUNK]) for i in range(0, len(parts), _CHUNK)])
+    return text, starts
+
+
+def _name_order(names: List[str]) -> Any:
+    """
+    Row positions sorted by name, in the same (code point) order `sorted` gives. Python's sort holds the GIL all the
+    way through, numpy's doesn't.
+    """
+    chunks = [np.array(names[i:i + _CHUNK], dtype=StringDType()) for i in range(0, len(names), _CHUNK)]
+    return np.argsort(np.concatenate(chunks) if chunks else np.array([], dtype=StringDType()), kind="stable")
+
+
+def _release(rows: List[Any]):
+    """Empties `rows` a chunk at a time, see `_CHUNK`."""
+    while rows:
+        del rows[-_CHUNK:]
+
+
+class CatalogIndex:
+    """
+    A columnar in-memory copy of the `items` table that answers `/shop/list` with numpy masks.
+
+    Prices, quantities and category codes live in numpy arrays indexed by row position, and `name_order`/`price_order`
+    are the row positions sorted by name and by price. Every query first asks `item_changes` what changed since the
+    last one, in this worker or any other, then re-reads just those rows and patches the arrays in place.
+
+    Searches match against all names and descriptions joined into one string (see `_join_search_text`), rows changed
+    since it was joined are checked on their own. A full load and a rejoin run in a worker thread, so the event loop
+    keeps serving other requests meanwhile.
+    """
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self.loaded = False
+        self.changes = ItemChangeReader()
+        self.lock = asyncio.Lock()
+
+        self.ids = np.empty(0, dtype=np.int64)
+        self.price = np.empty(0, dtype=np.float64)
+        self.quantity = np.empty(0, dtype=np.int64)
+        self.category_codes = np.empty(0, dtype=np.int32)
+        self.name_order = np.empty(0, dtype=np.int64)
+        self.price_order = np.empty(0, dtype=np.int64)
+
+        self.categories: List[str | None] = []
+        self.category_lookup: Dict[str | None, int] = {}
+        self.names: List[str] = []
+        self.brands: List[str | None] = []
+        self.descriptions: List[str | None] = []
+        # Lowercased names and descriptions, what searches are matched against.
+        self.search_names: List[str] = []
+        self.search_descriptions: List[str] = []
+        self.search_text = ""
+        self.search_starts = np.empty(0, dtype=np.int64)
+        # Rows whose name or description changed (or that were added) since `search_text` was joined.
+        self.search_stale: Set[int] = set()
+
+    def _category_code(self, category: str | None) -> int:
+        code = self.category_lookup.get(category)
+        if code is None:
+            code = len(self.categories)
+            self.categories.append(category)
+            self.category_lookup[category] = code
+        return code
+
+    @staticmethod
+    def _columns(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Every attribute of a freshly loaded index, built from `rows`. Runs in a worker thread."""
+        n = len(rows)
+        categories: List[str | None] = []
+        category_lookup: Dict[str | None, int] = {}
+        for category in dict.fromkeys(r["category"] for r in rows):
+            category_lookup[category] = len(categories)
+            categories.append(category)
+
+        names = [r["name"] for r in rows]
+        price = np.fromiter((r["price"] for r in rows), dtype=np.float64, count=n)
+        search_names = [name.lower() for name in names]
+        search_descriptions = [(r["description"] or "").lower() for r in rows]
+        search_text, search_starts = _join_search_text(search_names, search_descriptions)
+        return {
+            "categories": categories,
+            "category_lookup": category_lookup,
+            "ids": np.fromiter((r["id"] for r in rows), dtype=np.int64, count=n),
+            "price": price,
+            "quantity": np.fromiter((r["quantity"] for r in rows), dtype=np.int64, count=n),
+            "category_codes": np.fromiter((category_lookup[r["category"]] for r in rows), dtype=np.int32, count=n),
+            "names": names,
+            "brands": [r["brand"] for r in rows],
+            "descriptions": [r["description"] for r in rows],
+            "search_names": search_names,
+            "search_descriptions": search_descriptions,
+            "search_text": search_text,
+            "search_starts": search_starts,
+            "search_stale": set(),
+            "name_order": _name_order(names),
+            "price_order": np.argsort(price, kind="stable"),
+        }
+
+    async def _fetch(self, db: APIDatabase, item_ids: List[int] | None = None) -> List[Dict[str, Any]]:
+        return await db.fetch_items(LIST_FIELDS, item_ids)
+
+    async def _load(self, db: APIDatabase):
+        # Changes from here on may be newer than what the SELECT below sees, they get applied on top.
+        await self.changes.start(db)
+        rows: List[Dict[str, Any]] = []
+        while page := await db.fetch_items(
+            LIST_FIELDS, after_id=rows[-1]["id"] if rows else 0, limit=CATALOG_LOAD_BATCH
+        ):
+            rows += page
+        # Queries keep reading the old columns until the new ones are swapped in, all at once.
+        vars(self).update(await asyncio.to_thread(self._columns, rows))
+        self.loaded = True
+        self.logger.info(f"Loaded {len(rows)} items into the catalog index")
+        # A million dicts take a while to free too.
+        await asyncio.to_thread(_release, rows)
+
+    async def _rejoin_search_text(self):
+        # Nothing changes the rows while this runs, every change happens under `self.lock` and so does this.
+        self.search_text, self.search_starts = await asyncio.to_thread(
+            _join_search_text, self.search_names, self.search_descriptions
+        )
+        self.search_stale = set()
+
+    async def _refresh(self, db: APIDatabase, changed: Set[int]):
+        rows = await self._fetch(db, sorted(changed))
+        renamed: List[int] = []
+        repriced: List[int] = []
+        new_rows = []
+
+        for row in rows:
+            pos = int(np.searchsorted(self.ids, row["id"]))
+            if pos == len(self.ids) or self.ids[pos] != row["id"]:
+                new_rows.append(row)
+                continue
+
+            self.quantity[pos] = row["quantity"]
+            self.category_codes[pos] = self._category_code(row["category"])
+            self.brands[pos] = row["brand"]
+            self.descriptions[pos] = row["description"]
+            search_name, search_description = row["name"].lower(), (row["description"] or "").lower()
+            if (search_name, search_description) != (self.search_names[pos], self.search_descriptions[pos]):
+                self.search_names[pos], self.search_descriptions[pos] = search_name, search_description
+                self.search_stale.add(pos)
+            if self.names[pos] != row["name"]:
+                self.names[pos] = row["name"]
+                renamed.append(pos)
+            if self.price[pos] != row["price"]:
+                self.price[pos] = row["price"]
+                repriced.append(pos)
+
+        if new_rows:
+            # Ids only ever grow, so new items belong at the end. If one somehow doesn't, start over.
+            if len(self.ids) and new_rows[0]["id"] < self.ids[-1]:
+                await self._load(db)
+                return
+
+            start = len(self.ids)
+            self.ids = np.concatenate([self.ids, [r["id"] for r in new_rows]])
+            self.price = np.concatenate([self.price, [r["price"] for r in new_rows]])
+            self.quantity = np.concatenate([self.quantity, [r["quantity"] for r in new_rows]])
+            self.category_codes = np.concatenate(
+                [self.category_codes, np.array([self._category_code(r["category"]) for r in new_rows], dtype=np.int32)]
+            )
+            for r in new_rows:
+                self.names.append(r["name"])
+                self.brands.append(r["brand"])
+                self.descriptions.append(r["description"])
+                self.search_names.append(r["name"].lower())
+                self.search_descriptions.append((r["description"] or "").lower())
+
+            added = list(range(start, len(self.ids)))
+            self.search_stale.update(added)
+            renamed.extend(added)
+            repriced.extend(added)
+
+        if renamed:
+            self.name_order = self._resort(self.name_order, renamed, self.names.__getitem__)
+        if repriced:
+            self.price_order = self._resort(self.price_order, repriced, self.price.__getitem__)
+
+    @staticmethod
+    def _resort(order: Any, positions: List[int], key) -> Any:
+        """Takes `positions` out of a sort order and puts them back where their (new) keys belong."""
+        order = order[~np.isin(order, positions)]
+        positions = sorted(positions, key=key)
+        slots = [bisect.bisect_right(order, key(pos), key=key) for pos in positions]
+        return np.insert(order, slots, positions)
+
+    def _row(self, pos: int) -> Dict[str, Any]:
+        return {
+            "id": int(self.ids[pos]),
+            "name": self.names[pos],
+            "brand": self.brands[pos],
+            "description": self.descriptions[pos],
+            "category": self.categories[self.category_codes[pos]],
+            "price": float(self.price[pos]),
+            "quantity": int(self.quantity[pos]),
+        }
+
+    async def search_items(
+        self,
+        db: APIDatabase,
+        category: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        search: str | None = None,
+        limit: int = 20,
+        offset: int = 0,
+        sort_by: str = "name",
+        sort_order: str = "asc",
+    ) -> List[Dict[str, Any]]:
+        """Same arguments and same result as `APIDatabase.search_items`."""
+        async with self.lock:
+            changed = await self.changes.read(db, CATALOG_RELOAD_THRESHOLD) if self.loaded else None
+            if changed is None:
+                await self._load(db)
+            elif changed:
+                await self._refresh(db, changed)
+            if len(self.search_stale) > SEARCH_REBUILD_ROWS:
+                await self._rejoin_search_text()
+
+        mask = self.quantity > 0
+        if category:
+            code = self.category_lookup.get(category)
+            if code is None:
+                return []
+            mask &= self.category_codes == code
+        if min_price is not None and max_price is not None:
+            mask &= (self.price >= min_price) & (self.price <= max_price)
+
+        order = self.name_order if sort_by == "name" else self.price_order
+        if sort_order == "desc":
+            order = order[::-1]
+        candidates = order[mask[order]]
+
+        pattern = _search_pattern(search) if search else None
+        if pattern is not None:
+            # A common term fills the page from the first few candidates already, only a rarer one needs the full scan.
+            walked = [pos for pos in candidates[:SEARCH_WALK_ROWS] if self._matches(pattern, pos)]
+            if len(walked) >= offset + limit or len(candidates) <= SEARCH_WALK_ROWS:
+                return [self._row(pos) for pos in walked[offset:offset + limit]]
+            candidates = candidates[self._search_mask(pattern)[candidates]]
+
+        return [self._row(pos) for pos in candidates[offset:offset + limit]]
+
+    def _matches(self, pattern: "re.Pattern[str]", pos: int) -> bool:
+        return bool(pattern.search(self.search_names[pos]) or pattern.search(self.search_descriptions[pos]))
+
+    def _search_mask(self, pattern: "re.Pattern[str]") -> Any:
+        """Which rows `pattern` matches, by one scan of the search text plus a look at each row changed since."""
+        starts = np.fromiter((match.start() for match in pattern.finditer(self.search_text)), dtype=np.int64)
+        mask = np.zeros(len(self.ids), dtype=bool)
+        # Names and descriptions alternate in the search text, so part `i` belongs to row `i // 2`.
+        mask[(np.searchsorted(self.search_starts, starts, side="right") - 1) // 2] = True
+        for pos in self.search_stale:
+            mask[pos] = self._matches(pattern, pos)
+        return mask
+
+
+catalog_logger = Logger("catalog")
+catalog_index: Optional[CatalogIndex] = None
+
+if CATALOG_ENGINE == "columnar":
+    if np is None:
+        catalog_logger.warn("CATALOG_ENGINE=columnar needs numpy 2 or later installed, /shop/list will use SQL")
+    else:
+        catalog_index = CatalogIndex(catalog_logger)
@@ -0,0 +1,58 @@
+from typing import (
+    Dict,
+    Optional,
+    Set,
+)
+
+import time
+
+from database import APIDatabase
+
+# How long a hole in the sequence numbers is waited on before it's taken for a write that was rolled back.
+GAP_TIMEOUT = 30.0
+
+
+class ItemChangeReader:
+    """
+    Follows the `item_changes` table, which triggers on `items` append to on every write, from whichever worker
+    process. This is how in-memory copies of items hear about writes other workers made.
+
+    On SQLite writers take turns, so rows show up in sequence order. On Postgres a write can commit after a later
+    numbered one, which leaves a hole that fills in afterwards. The reader keeps asking for those numbers until they
+    show up or `GAP_TIMEOUT` passes.
+    """
+
+    def __init__(self):
+        self.seq: Optional[int] = None
+        self.gaps: Dict[int, float] = {}
+
+    async def start(self, db: APIDatabase):
+        """Skips to the newest change, call it right before loading a fresh copy of the items."""
+        self.seq = (await db.item_change_bounds())["last"]
+        self.gaps = {}
+
+    async def read(self, db: APIDatabase, limit: int) -> Optional[Set[int]]:
+        """
+        The ids of the items changed since the last read. None if the caller has to start over instead: the changes
+        it hasn't seen were already deleted, or there are more than `limit` of them.
+        """
+        bounds = await db.item_change_bounds()
+        if self.seq is None or bounds["first"] > self.seq + 1 or bounds["last"] - self.seq > limit:
+            return None
+        if bounds["last"] <= self.seq and not self.gaps:
+            return set()
+
+        now = time.monotonic()
+        self.gaps = {seq: since for seq, since in self.gaps.items() if now - since < GAP_TIMEOUT}
+        rows = await db.item_changes(self.seq, list(self.gaps))
+
+        changed: Set[int] = set()
+        for row in rows:
+            seq = row["seq"]
+            if seq > self.seq:
+                self.gaps.update((missing, now) for missing in range(self.seq + 1, seq))
+                self.seq = seq
+            else:
+                self.gaps.pop(seq, None)
+            changed.add(row["item_id"])
+        return changed
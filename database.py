@@ -11,87 +11,344 @@ import asqlite
 import bcrypt
 
 from logger import Logger
+from tracing import span
 
 
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    with span("hashing"):
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
 
 def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode(), hashed.encode())
+    with span("hashing"):
+        return bcrypt.checkpw(password.encode(), hashed.encode())
 
 
 import os
 import datetime
 import asqlite
-from typing import List, Dict, Any
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, AsyncIterator, Callable, Sequence, Set
 from pathlib import Path
 from logger import Logger
 
+# Which storage backend to use: `sqlite` (a single file, one writer at a time) or `postgres` (see postgres.py).
+DATABASE_BACKEND = os.getenv("DATABASE_BACKEND", "sqlite")
+if DATABASE_BACKEND not in ("sqlite", "postgres"):
+    raise ValueError(f"DATABASE_BACKEND must be sqlite or postgres, not {DATABASE_BACKEND!r}")
+
 DB_PATH = "api_data.db"
+ARCHIVE_DB_PATH = "api_archive.db"
+
+# Columns of the `orders` table, the archive keeps the exact same ones.
+ORDER_COLUMNS = (
+    "id", "user_id", "item_id", "quantity", "total_price", "date_ordered",
+    "username", "item_name", "item_brand", "unit_price",
+)
+# Copies of the user and item as they were when the order was placed, so reading orders needs no joins.
+ORDER_SNAPSHOT_COLUMNS = {"username": "TEXT", "item_name": "TEXT", "item_brand": "TEXT", "unit_price": "REAL"}
+# Which job runner is running a job and when it last reported progress, added to `jobs` tables that predate them.
+JOB_OWNER_COLUMNS = {"owner": "TEXT", "heartbeat": "TEXT"}
+
+# The columns `/shop/list` returns, in order. The SQL path and the catalog index both produce exactly these keys.
+LIST_FIELDS = ("id", "name", "brand", "description", "category", "price", "quantity")
+
+# Upper bounds of the price buckets `/shop/facets` counts in, a bucket is [previous bound, bound) and the last one is open ended.
+FACET_PRICE_BUCKETS = [float(b) for b in os.getenv("FACET_PRICE_BUCKETS", "500,1000,2000,5000").split(",")]
+FACET_NAMES = ("category", "brand", "price")
+
+# Rows of `item_changes` kept for readers that fell behind, older ones are deleted as new ones come in.
+ITEM_CHANGES_KEEP = int(os.getenv("ITEM_CHANGES_KEEP", "100000"))
+# The item columns whose changes land in `item_changes`, everything the in-memory copies of items hold.
+ITEM_CHANGE_COLUMNS = ("name", "brand", "description", "category", "price", "quantity")
+
+# Anything that caches item data in memory registers here, it gets called with the ids of the items a commit touched.
+# That only covers this process, see `item_changes` for writes made by other workers.
+item_listeners: List[Callable[[Set[int]], None]] = []
+
+
+def _price_bucket_labels() -> List[str]:
+    labels = []
+    lower = 0.0
+    for upper in FACET_PRICE_BUCKETS:
+        labels.append(f"{lower:g}-{upper:g}")
+        lower = upper
+    labels.append(f"{lower:g}+")
+    return labels
+
+PRICE_BUCKET_LABELS = _price_bucket_labels()
+
+
+def _facet_expressions(row: str = "") -> Dict[str, str]:
+    """SQL for the facet values of an item, `row` is the `NEW.`/`OLD.` prefix inside triggers."""
+    cases = " ".join(
+        f"WHEN {row}price < {upper!r} THEN '{label}'" for upper, label in zip(FACET_PRICE_BUCKETS, PRICE_BUCKET_LABELS)
+    )
+    return {
+        "category": f"COALESCE({row}category, '')",
+        "brand": f"COALESCE({row}brand, '')",
+        "price": f"CASE {cases} ELSE '{PRICE_BUCKET_LABELS[-1]}' END",
+    }
+
+
+# The statements both backends' facet triggers are made of: count an item in, or out, of its facets when `when` holds.
+def _facet_add(exprs: Dict[str, str], when: str) -> str:
+    return "".join(
+        f"INSERT INTO facet_counts (category, facet, value, count) SELECT {exprs['category']}, '{facet}', {expr}, 1 "
+        f"WHERE {when} ON CONFLICT (category, facet, value) DO UPDATE SET count = facet_counts.count + 1;\n"
+        for facet, expr in exprs.items()
+    )
+
+
+def _facet_remove(exprs: Dict[str, str], when: str) -> str:
+    return "".join(
+        f"UPDATE facet_counts SET count = count - 1 "
+        f"WHERE category = {exprs['category']} AND facet = '{facet}' AND value = {expr} AND {when};\n"
+        for facet, expr in exprs.items()
+    )
+
+
+def _facet_rebuild() -> List[str]:
+    """Statements that refill an empty `facet_counts` from one scan of `items`."""
+    exprs = _facet_expressions()
+    return [
+        f"INSERT INTO facet_counts (category, facet, value, count) "
+        f"SELECT {exprs['category']}, '{facet}', {expr}, COUNT(*) FROM items WHERE quantity > 0 GROUP BY 1, 3"
+        for facet, expr in exprs.items()
+    ]
+
+
+def _facet_triggers() -> List[str]:
+    """
+    Triggers that keep `facet_counts` in step with `items`, so every write path (single, bulk or an order) updates it
+    in the same transaction. The update trigger only fires when an item's facets or its in-stock state actually change,
+    so ordinary stock decrements don't pay for it.
+    """
+    new, old = _facet_expressions("NEW."), _facet_expressions("OLD.")
+    changed = (
+        "(OLD.quantity > 0) != (NEW.quantity > 0) OR OLD.brand IS NOT NEW.brand "
+        f"OR OLD.category IS NOT NEW.category OR ({old['price']}) != ({new['price']})"
+    )
+    return [
+        f"CREATE TRIGGER items_facets_insert AFTER INSERT ON items BEGIN\n{_facet_add(new, 'NEW.quantity > 0')}END",
+        f"CREATE TRIGGER items_facets_update AFTER UPDATE OF quantity, price, brand, category ON items WHEN {changed} BEGIN\n"
+        f"{_facet_remove(old, 'OLD.quantity > 0')}{_facet_add(new, 'NEW.quantity > 0')}END",
+        f"CREATE TRIGGER items_facets_delete AFTER DELETE ON items BEGIN\n{_facet_remove(old, 'OLD.quantity > 0')}END",
+    ]
+
+
+def _item_change_triggers() -> List[str]:
+    """
+    Triggers that append every item write to `item_changes`, whichever worker process makes it, and drop the rows
+    that fell out of the last `ITEM_CHANGES_KEEP`. See `changes.ItemChangeReader` for the other end.
+    """
+    log = "INSERT INTO item_changes (item_id) VALUES ({});\n"
+    return [
+        f"CREATE TRIGGER items_changes_insert AFTER INSERT ON items BEGIN\n{log.format('NEW.id')}END",
+        f"CREATE TRIGGER items_changes_update AFTER UPDATE OF {', '.join(ITEM_CHANGE_COLUMNS)} ON items BEGIN\n"
+        f"{log.format('NEW.id')}END",
+        f"CREATE TRIGGER items_changes_delete AFTER DELETE ON items BEGIN\n{log.format('OLD.id')}END",
+        "CREATE TRIGGER item_changes_prune AFTER INSERT ON item_changes BEGIN\n"
+        f"DELETE FROM item_changes WHERE seq <= NEW.seq - {ITEM_CHANGES_KEEP};\nEND",
+    ]
+
+
+class OutOfStockError(Exception):
+    """An order asked for more of an item than was left in stock."""
+
+    def __init__(self, item_id: int):
+        super().__init__(f"Not enough stock of item {item_id}")
+        self.item_id = item_id
 
 
-class APIDatabase:
+class APIDatabase(ABC):
+    """
+    The storage interface everything else talks to, one instance per request (or per background task).
+
+    The queries themselves live here and are written in the SQL both backends understand, with `?` placeholders.
+    A backend only provides the connection, the `_fetch`/`_fetchrow`/`_execute`/`_executemany`/`_insert` primitives they
+    run through, and the few things that really differ: the schema, bulk writes and the order archive.
+    Use `open_db` to get the configured backend.
+    """
+
+    # SQLite's LIKE ignores case already, backends where it doesn't override this.
+    like = "LIKE"
+
     def __init__(self, logger: Logger):
-        self.db_name = os.getenv("DATABASE_NAME", DB_PATH)
         self.logger = logger
-        self.conn: asqlite.Connection
+        self.archive_attached = False
+        self.changed_items: Set[int] = set()
+        self.in_transaction = False
 
+    @abstractmethod
     async def __aenter__(self):
-        self.conn = await asqlite.connect(self.db_name)
-        self.logger.info("Database connection opened")
-        return self
+        ...
 
+    @abstractmethod
     async def __aexit__(self, *args, **kwargs):
-        if self.conn:
-            await self.conn.close()
-        self.logger.info("Database connection closed")
+        ...
+
+
+    @abstractmethod
+    async def _fetch(self, query: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def _fetchrow(self, query: str, params: Sequence[Any] = ()) -> Dict[str, Any] | None:
+        ...
+
+    @abstractmethod
+    async def _execute(self, query: str, params: Sequence[Any] = ()) -> int:
+        """Runs a statement and returns how many rows it changed."""
+
+    @abstractmethod
+    async def _executemany(self, query: str, rows: Sequence[Sequence[Any]]):
+        ...
+
+    @abstractmethod
+    async def _insert(self, query: str, params: Sequence[Any] = ()) -> int:
+        """Runs an INSERT into a table with an `id` column and returns the new row's id."""
+
+    @abstractmethod
+    def _transaction(self):
+        """The backend's own transaction context manager."""
+
+    @abstractmethod
+    async def _commit(self):
+        ...
+
+
+    async def commit(self):
+        """
+        Commits and then lets the `item_listeners` know which items changed.
+        Inside `transaction()` this does nothing, the transaction commits (and notifies) when it ends.
+        """
+        if self.in_transaction:
+            return
+        await self._commit()
+        if self.changed_items:
+            changed, self.changed_items = self.changed_items, set()
+            for listener in item_listeners:
+                listener(changed)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["APIDatabase"]:
+        """
+        Runs the block as one transaction, everything in it is committed together or not at all.
+        A transaction inside another one just joins it.
+        """
+        if self.in_transaction:
+            yield self
+            return
+
+        self.in_transaction = True
+        try:
+            async with self._transaction():
+                yield self
+        except BaseException:
+            self.changed_items.clear()
+            raise
+        finally:
+            self.in_transaction = False
+        await self.commit()
+
+
+    async def get_meta(self, key: str) -> str | None:
+        row = await self._fetchrow("SELECT value FROM meta WHERE key = ?", (key,))
+        return row["value"] if row else None
+
+    async def set_meta(self, **values: str):
+        """Sets several `meta` keys in one commit."""
+        await self._executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            list(values.items())
+        )
+        await self.commit()
 
 
     async def create_user(self, username: str, password_hash: str):
-        cur = await self.conn.execute(
+        await self._execute(
             "INSERT INTO users (username, password_hash) VALUES (?, ?)",
             (username, password_hash)
         )
-        await self.conn.commit()
+        await self.commit()
 
 
     async def get_user(self, username: str) -> Dict[str, Any] | None:
-        cur = await self.conn.execute(
+        return await self._fetchrow(
             "SELECT id, username, password_hash FROM users WHERE username = ?",
             (username,)
         )
-        row = await cur.fetchone()
-        return dict(row) if row else None
 
     async def get_admin(self, username: str) -> Dict[str, Any] | None:
-        cur = await self.conn.execute(
+        return await self._fetchrow(
             "SELECT id, username, password_hash FROM admins WHERE username = ?",
             (username,)
         )
-        row = await cur.fetchone()
-        return dict(row) if row else None
 
 
     async def list_items(self) -> List[Dict[str, Any]]:
-        cur = await self.conn.execute(
+        return await self._fetch(
             "SELECT id, name, brand, date_created, date_restocked FROM items"
         )
-        rows = await cur.fetchall()
-        return [dict(row) for row in rows]
+
+    async def fetch_items(
+        self, fields: Sequence[str], item_ids: List[int] | None = None, after_id: int = 0, limit: int | None = None
+    ) -> List[Dict[str, Any]]:
+        """
+        `fields` of every item, or only of `item_ids`, ordered by id. For the in-memory caches of items.
+
+        With `limit`, only that many items with ids past `after_id`, to read every item a page at a time.
+        """
+        query = f"SELECT {', '.join(fields)} FROM items"
+        if item_ids is None:
+            if limit is not None:
+                return await self._fetch(query + " WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+            return await self._fetch(query + " ORDER BY id")
+
+        rows = []
+        # Batched, SQLite caps how many parameters a statement can have.
+        for start in range(0, len(item_ids), 500):
+            batch = item_ids[start:start + 500]
+            rows += await self._fetch(
+                query + f" WHERE id IN ({', '.join('?' for _ in batch)}) ORDER BY id", batch
+            )
+        return rows
+
+    async def item_change_bounds(self) -> Dict[str, int]:
+        """The oldest and newest `item_changes` sequence numbers still there, 0 for an empty table."""
+        # Two subqueries, both backends answer a lone MIN or MAX from the primary key but not the pair together.
+        return await self._fetchrow(
+            "SELECT COALESCE((SELECT MIN(seq) FROM item_changes), 0) AS first, "
+            "COALESCE((SELECT MAX(seq) FROM item_changes), 0) AS last"
+        )
+
+    async def item_changes(self, after: int, also: Sequence[int] = ()) -> List[Dict[str, Any]]:
+        """The `item_changes` rows after `after` (and those numbered `also`), oldest first."""
+        query = "SELECT seq, item_id FROM item_changes WHERE seq > ?"
+        if also:
+            query += f" OR seq IN ({', '.join('?' for _ in also)})"
+        return await self._fetch(query + " ORDER BY seq", (after, *also))
+
+    async def get_categories(self) -> List[str]:
+        """Every category that has something in stock."""
+        rows = await self._fetch("SELECT DISTINCT category FROM items WHERE quantity > 0")
+        return [row["category"] for row in rows if row["category"]]
 
     async def create_item(self, name, brand, description, category, quantity, price):
         now = datetime.datetime.now(datetime.timezone.utc).isoformat()
-        await self.conn.execute(
+        item_id = await self._insert(
             "INSERT INTO items (name, brand, description, category, quantity, price, date_created, date_restocked) "
             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
             (name, brand, description, category, quantity, price, now, now)
         )
-        await self.conn.commit()
+        self.changed_items.add(item_id)
+        await self.commit()
 
     async def get_item(self, item_id: int) -> Dict[str, Any] | None:
-        cur = await self.conn.execute("SELECT * FROM items WHERE id = ?", (item_id,))
-        row = await cur.fetchone()
-        return dict(row) if row else None
+        return await self._fetchrow("SELECT * FROM items WHERE id = ?", (item_id,))
 
     async def update_item(self, item_id: int, **kwargs):
         if not kwargs:
@@ -103,42 +360,450 @@ class APIDatabase:
             values.append(v)
         values.append(item_id)
         query = f"UPDATE items SET {', '.join(fields)} WHERE id = ?"
-        await self.conn.execute(query, tuple(values))
-        await self.conn.commit()
+        await self._execute(query, tuple(values))
+        self.changed_items.add(item_id)
+        await self.commit()
 
     async def restock_item(self, item_id: int, quantity: int):
         now = datetime.datetime.now(datetime.timezone.utc).isoformat()
-        await self.conn.execute(
+        await self._execute(
             "UPDATE items SET quantity = quantity + ?, date_restocked = ? WHERE id = ?",
             (quantity, now, item_id)
         )
-        await self.conn.commit()
+        self.changed_items.add(item_id)
+        await self.commit()
 
 
-    async def get_orders(self) -> List[Dict[str, Any]]:
-        cur = await self.conn.execute("""
-            SELECT orders.id AS order_id, orders.item_id, items.name AS item_name,
-                   users.id AS user_id, users.username,
-                   orders.quantity, orders.total_price, orders.date_ordered
-            FROM orders
-            JOIN users ON orders.user_id = users.id
-            JOIN items ON orders.item_id = items.id
-        """)
-        rows = await cur.fetchall()
-        return [dict(row) for row in rows]
+    @abstractmethod
+    async def create_items(self, rows: List[tuple]) -> int:
+        """
+        Inserts many `(name, brand, description, category, quantity, price)` rows at once.
+        This does not commit, the caller owns the transaction so a chunk and its job progress land together.
+        """
+
+    @abstractmethod
+    async def restock_items(self, rows: List[tuple]) -> int:
+        """
+        Restocks many `(item_id, quantity)` rows at once and returns how many rows were for items that actually exist.
+        Like `create_items`, this does not commit.
+        """
+
+
+    async def search_items(
+        self,
+        category: str | None = None,
+        min_price: float | None = None,
+        max_price: float | None = None,
+        search: str | None = None,
+        limit: int = 20,
+        offset: int = 0,
+        sort_by: str = "name",
+        sort_order: str = "asc",
+    ) -> List[Dict[str, Any]]:
+        """The in-stock catalog listing behind `/shop/list`. `sort_by` and `sort_order` must already be validated."""
+        query = f"SELECT {', '.join(LIST_FIELDS)} FROM items WHERE quantity > 0"
+        params: List[Any] = []
+
+        if category:
+            query += " AND category = ?"
+            params.append(category)
+
+        if min_price is not None and max_price is not None:
+            query += " AND price BETWEEN ? AND ?"
+            params.extend([min_price, max_price])
+
+        if search:
+            search_term = f"%{search}%"
+            query += f" AND (name {self.like} ? OR description {self.like} ?)"
+            params.extend([search_term, search_term])
+
+        query += f" ORDER BY {sort_by} {sort_order.upper()}"
+
+        query += " LIMIT ? OFFSET ?"
+        params.extend([limit, offset])
+
+        return await self._fetch(query, tuple(params))
+
+
+    async def get_facets(self, category: str | None = None, search: str | None = None) -> Dict[str, Dict[str, int]]:
+        """
+        In-stock item counts per category, brand and price bucket.
+        Without a search this only reads `facet_counts`, a search has to scan the matching items instead.
+        """
+        if search:
+            exprs = _facet_expressions()
+            query = (
+                f"SELECT {exprs['category']} AS category, {exprs['brand']} AS brand, {exprs['price']} AS price, "
+                f"COUNT(*) AS count FROM items WHERE quantity > 0 AND (name {self.like} ? OR description {self.like} ?)"
+            )
+            params: List[Any] = [f"%{search}%", f"%{search}%"]
+            if category:
+                query += " AND category = ?"
+                params.append(category)
+            rows = [
+                (facet, row[facet], row["count"])
+                for row in await self._fetch(query + " GROUP BY 1, 2, 3", tuple(params))
+                for facet in FACET_NAMES
+            ]
+        else:
+            query = "SELECT facet, value, SUM(count) AS count FROM facet_counts"
+            params = []
+            if category:
+                query += " WHERE category = ?"
+                params.append(category)
+            rows = [
+                (row["facet"], row["value"], row["count"])
+                for row in await self._fetch(query + " GROUP BY facet, value", tuple(params))
+            ]
+
+        facets: Dict[str, Dict[str, int]] = {facet: {} for facet in FACET_NAMES}
+        for facet, value, count in rows:
+            if value and count > 0:
+                facets[facet][value] = facets[facet].get(value, 0) + count
+
+        facets["category"] = dict(sorted(facets["category"].items()))
+        facets["brand"] = dict(sorted(facets["brand"].items()))
+        facets["price"] = {label: facets["price"][label] for label in PRICE_BUCKET_LABELS if label in facets["price"]}
+        return facets
+
+
+    async def place_order(self, user_id: int, username: str, item: Dict[str, Any], quantity: int, date_ordered: str) -> int:
+        """
+        Records an order for `item` (as returned by `get_item`) and takes its quantity out of stock, returning the new order id.
+        The order keeps its own copy of the username and the item's name, brand and price.
+        Raises `OutOfStockError`, having changed nothing, if the item no longer has `quantity` in stock.
+        This does not commit, run it inside `transaction()` so a checkout places all of its orders or none.
+        """
+        # Checked in the same statement that takes the stock, so concurrent orders can't take more than there is.
+        taken = await self._execute(
+            "UPDATE items SET quantity = quantity - ? WHERE id = ? AND quantity >= ?",
+            (quantity, item["id"], quantity)
+        )
+        if not taken:
+            raise OutOfStockError(item["id"])
+        order_id = await self._insert(
+            "INSERT INTO orders (user_id, item_id, quantity, total_price, date_ordered, username, item_name, item_brand, unit_price) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                user_id, item["id"], quantity, item["price"] * quantity, date_ordered,
+                username, item["name"], item["brand"], item["price"]
+            )
+        )
+        self.changed_items.add(item["id"])
+        return order_id
+
+
+    async def create_job(self, job_id: str, kind: str, file_path: str):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        await self._execute(
+            "INSERT INTO jobs (id, kind, status, file_path, date_created) VALUES (?, ?, 'queued', ?, ?)",
+            (job_id, kind, file_path, now)
+        )
+        await self.commit()
+
+    async def get_job(self, job_id: str) -> Dict[str, Any] | None:
+        return await self._fetchrow("SELECT * FROM jobs WHERE id = ?", (job_id,))
+
+    async def list_jobs(self, *statuses: str) -> List[Dict[str, Any]]:
+        query = "SELECT * FROM jobs"
+        if statuses:
+            query += f" WHERE status IN ({', '.join('?' for _ in statuses)})"
+        return await self._fetch(query + " ORDER BY date_created", statuses)
+
+    async def update_job(
+        self, job_id: str, if_status: Sequence[str] = (), if_owner: str | None = None, **kwargs
+    ) -> bool:
+        """
+        Sets the given columns of a job. With `if_status` or `if_owner` only while the job is in one of those statuses
+        or still claimed by that runner, so the check and the change can't be split by another worker.
+        Returns whether the job was updated.
+        """
+        if not kwargs:
+            return False
+        fields = []
+        values: List[Any] = []
+        for k, v in kwargs.items():
+            fields.append(f"{k} = ?")
+            values.append(v)
+        query = f"UPDATE jobs SET {', '.join(fields)} WHERE id = ?"
+        values.append(job_id)
+        if if_status:
+            query += f" AND status IN ({', '.join('?' for _ in if_status)})"
+            values.extend(if_status)
+        if if_owner is not None:
+            query += " AND owner = ?"
+            values.append(if_owner)
+        updated = await self._execute(query, tuple(values))
+        await self.commit()
+        return updated > 0
+
+    async def claim_job(self, job_id: str, owner: str, stale_before: str) -> bool:
+        """
+        Makes `owner` the one runner of a job that is queued, or running under a runner whose last heartbeat is older
+        than `stale_before` (it died or hung). Returns whether the job is now ours to run.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        claimed = await self._execute(
+            "UPDATE jobs SET status = 'running', owner = ?, heartbeat = ?, date_started = COALESCE(date_started, ?) "
+            "WHERE id = ? AND (status = 'queued' OR (status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)))",
+            (owner, now, now, job_id, stale_before)
+        )
+        await self.commit()
+        return claimed > 0
+
+    async def release_jobs(self, owner: str) -> int:
+        """Puts the jobs `owner` is running back in the queue, for when that runner shuts down."""
+        released = await self._execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL, heartbeat = NULL WHERE owner = ? AND status = 'running'",
+            (owner,)
+        )
+        await self.commit()
+        return released
+
+
+    @abstractmethod
+    async def attach_archive(self, create: bool = False) -> bool:
+        """
+        Makes the order archive readable as `archive.orders`. Returns whether it is there.
+        Readers never create it, only the archiver does (with `create=True`).
+        """
+
+    async def get_orders(
+        self, user_id: int | None = None, since: str | None = None, until: str | None = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Orders placed in [since, until), optionally for one user only. Dates are UTC ISO strings.
+
+        Orders older than the archive cutoff live in the archive. It is only attached and
+        UNIONed in when `since` reaches back past the cutoff, and the hot table is skipped when `until` doesn't reach it.
+        """
+        select = """
+            SELECT orders.id AS order_id, orders.item_id, orders.item_name, orders.item_brand,
+                   orders.user_id, orders.username,
+                   orders.quantity, orders.unit_price, orders.total_price, orders.date_ordered
+            FROM {table} AS orders
+            WHERE {where}
+        """
+        filters = ["1 = 1"]
+        params: List[Any] = []
+        if user_id is not None:
+            filters.append("orders.user_id = ?")
+            params.append(user_id)
+        if since:
+            filters.append("orders.date_ordered >= ?")
+            params.append(since)
+        if until:
+            filters.append("orders.date_ordered < ?")
+            params.append(until)
+
+        while True:
+            cutoff = await self.get_meta("orders_archived_before")
+            parts = []
+            query_params: List[Any] = []
+            if cutoff is None or until is None or until > cutoff:
+                hot = filters + (["orders.date_ordered >= ?"] if cutoff else [])
+                parts.append(select.format(table="orders", where=" AND ".join(hot)))
+                query_params += params + ([cutoff] if cutoff else [])
+            if cutoff is not None and (since is None or since < cutoff) and await self.attach_archive():
+                parts.append(select.format(table="archive.orders", where=" AND ".join(filters + ["orders.date_ordered < ?"])))
+                query_params += params + [cutoff]
+
+            rows = []
+            # Neither table can have orders in a range that starts at or after the cutoff and ends at or before it.
+            if parts:
+                rows = await self._fetch(" UNION ALL ".join(parts) + " ORDER BY order_id", tuple(query_params))
+            # If the archiver moved the cutoff while we were reading, the hot rows we relied on may be gone, so go again.
+            if await self.get_meta("orders_archived_before") == cutoff:
+                return rows
 
     async def get_revenue(self) -> float:
-        cur = await self.conn.execute("SELECT SUM(total_price) AS revenue FROM orders")
-        row = await cur.fetchone()
-        return row["revenue"] or 0
+        """Revenue of the hot orders plus the running total the archiver keeps for everything it moved out."""
+        # One statement, so the cutoff and the hot table are read from the same snapshot.
+        row = await self._fetchrow("""
+            SELECT (
+                SELECT COALESCE(SUM(total_price), 0) FROM orders
+                WHERE date_ordered >= COALESCE((SELECT value FROM meta WHERE key = 'orders_archived_before'), '')
+            ) + COALESCE((SELECT CAST(value AS DOUBLE PRECISION) FROM meta WHERE key = 'archived_revenue'), 0) AS revenue
+        """)
+        return (row["revenue"] or 0) if row else 0
 
 
+    # Archiving happens in three steps so readers see every order exactly once the whole time:
+    # copy old orders into the archive, move the cutoff, then delete them from the hot table.
+    async def copy_orders_to_archive(self, before: str, after_id: int, batch_size: int) -> tuple | None:
+        """
+        Copies the next batch of orders older than `before` with an id past `after_id` into the archive.
+        Returns `(last_id, copied)`, or None once there is nothing left to copy.
+        """
+        row = await self._fetchrow(
+            "SELECT MAX(id) AS last_id FROM (SELECT id FROM orders WHERE date_ordered < ? AND id > ? ORDER BY id LIMIT ?) AS batch",
+            (before, after_id, batch_size)
+        )
+        last_id = row["last_id"] if row else None
+        if last_id is None:
+            return None
+
+        columns = ", ".join(ORDER_COLUMNS)
+        copied = await self._execute(
+            f"INSERT INTO archive.orders ({columns}) SELECT {columns} FROM orders "
+            "WHERE id > ? AND id <= ? AND date_ordered < ? ON CONFLICT (id) DO NOTHING",
+            (after_id, last_id, before)
+        )
+        return last_id, copied
+
+    async def advance_archive_cutoff(self, before: str):
+        """Moves the hot/cold boundary to `before`. Every order older than that must already be in the archive."""
+        row = await self._fetchrow(
+            "SELECT COALESCE(SUM(total_price), 0) AS revenue FROM archive.orders WHERE date_ordered < ?", (before,)
+        )
+        await self.set_meta(orders_archived_before=before, archived_revenue=repr(row["revenue"] if row else 0))
+
+    async def delete_archived_orders(self, batch_size: int) -> int:
+        """Deletes a batch of hot orders that are older than the cutoff (and so already archived)."""
+        cutoff = await self.get_meta("orders_archived_before")
+        if cutoff is None:
+            return 0
+        return await self._execute(
+            "DELETE FROM orders WHERE id IN (SELECT id FROM orders WHERE date_ordered < ? LIMIT ?)",
+            (cutoff, batch_size)
+        )
+
+
+    @abstractmethod
+    async def create_schema(self):
+        """Creates (or upgrades) every table, index and trigger. Safe to run on every start."""
+
+
+class SQLiteDatabase(APIDatabase):
+    """The SQLite backend, one `asqlite` connection per instance. The archive is a second file ATTACHed on demand."""
+
+    def __init__(self, logger: Logger):
+        super().__init__(logger)
+        self.db_name = os.getenv("DATABASE_NAME", DB_PATH)
+        self.archive_name = os.getenv("ARCHIVE_DATABASE_NAME", ARCHIVE_DB_PATH)
+        self.conn: asqlite.Connection
+
+    async def __aenter__(self):
+        with span("db"):
+            self.conn = await asqlite.connect(self.db_name)
+        self.logger.info("Database connection opened")
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        if self.conn:
+            await self.conn.close()
+        self.logger.info("Database connection closed")
+
+
+    async def _fetch(self, query: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        with span("db"):
+            cur = await self.conn.execute(query, tuple(params))
+            rows = await cur.fetchall()
+            return [dict(row) for row in rows]
+
+    async def _fetchrow(self, query: str, params: Sequence[Any] = ()) -> Dict[str, Any] | None:
+        with span("db"):
+            cur = await self.conn.execute(query, tuple(params))
+            row = await cur.fetchone()
+            return dict(row) if row else None
+
+    async def _execute(self, query: str, params: Sequence[Any] = ()) -> int:
+        with span("db"):
+            cur = await self.conn.execute(query, tuple(params))
+            return cur.get_cursor().rowcount
+
+    async def _executemany(self, query: str, rows: Sequence[Sequence[Any]]):
+        with span("db"):
+            await self.conn.executemany(query, rows)
+
+    async def _insert(self, query: str, params: Sequence[Any] = ()) -> int:
+        with span("db"):
+            cur = await self.conn.execute(query, tuple(params))
+            return cur.get_cursor().lastrowid
+
+    def _transaction(self):
+        return self.conn.transaction()
+
+    async def _commit(self):
+        with span("db"):
+            await self.conn.commit()
+
+
+    async def create_items(self, rows: List[tuple]) -> int:
+        if not rows:
+            return 0
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        await self.conn.executemany(
+            "INSERT INTO items (name, brand, description, category, quantity, price, date_created, date_restocked) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(*row, now, now) for row in rows]
+        )
+        # We are inside the caller's transaction, so the new ids are the contiguous block ending at the last one.
+        cur = await self.conn.execute("SELECT last_insert_rowid() AS last_id")
+        last_id = (await cur.fetchone())["last_id"]
+        self.changed_items.update(range(last_id - len(rows) + 1, last_id + 1))
+        return len(rows)
+
+    async def restock_items(self, rows: List[tuple]) -> int:
+        if not rows:
+            return 0
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        cur = await self.conn.executemany(
+            "UPDATE items SET quantity = quantity + ?, date_restocked = ? WHERE id = ?",
+            [(quantity, now, item_id) for item_id, quantity in rows]
+        )
+        self.changed_items.update(item_id for item_id, _ in rows)
+        return cur.get_cursor().rowcount
+
+
+    async def attach_archive(self, create: bool = False) -> bool:
+        # ATTACH is per connection, so this happens at most once per instance.
+        if self.archive_attached:
+            return True
+        if not create and not os.path.exists(self.archive_name):
+            return False
+
+        await self.conn.execute("ATTACH DATABASE ? AS archive", (self.archive_name,))
+        if create:
+            await self.conn.execute("PRAGMA archive.journal_mode = WAL")
+            await self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS archive.orders (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                item_id INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                total_price REAL NOT NULL,
+                date_ordered TEXT,
+                username TEXT,
+                item_name TEXT,
+                item_brand TEXT,
+                unit_price REAL
+            )
+            """)
+            await self.conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_orders_date ON orders (date_ordered)")
+            await self.conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_orders_user_date ON orders (user_id, date_ordered)")
+        self.archive_attached = True
+        return True
+
+
+    async def create_schema(self):
+        # The maintenance scheduler hands free pages back a few at a time, which needs incremental auto-vacuum.
+        # The mode only changes with a VACUUM. On a new, empty file that costs nothing, an existing one is left alone:
+        # rewriting it locks out every writer, so that only happens when an admin asks for it.
+        cur = await self.conn.execute("PRAGMA auto_vacuum")
+        if (await cur.fetchone())[0] != 2:
+            cur = await self.conn.execute("SELECT COUNT(*) AS count FROM sqlite_master")
+            if (await cur.fetchone())["count"]:
+                self.logger.info(
+                    f"{self.db_name} doesn't use incremental auto-vacuum, so maintenance can't free pages. "
+                    "POST /inventory/maintenance with full_vacuum=true switches it over with one full VACUUM."
+                )
+            else:
+                await self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await self.conn.execute("VACUUM")
 
-async def init_db():
-    logger = Logger("api.log")
-    async with APIDatabase(logger) as db:
         # Users table
-        await db.conn.execute("""
+        await self.conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
@@ -146,7 +811,7 @@ async def init_db():
         )
         """)
         # Admins table
-        await db.conn.execute("""
+        await self.conn.execute("""
         CREATE TABLE IF NOT EXISTS admins (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
@@ -154,7 +819,7 @@ async def init_db():
         )
         """)
         # Items table
-        await db.conn.execute("""
+        await self.conn.execute("""
         CREATE TABLE IF NOT EXISTS items (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -168,7 +833,7 @@ async def init_db():
         )
         """)
         # Orders table
-        await db.conn.execute("""
+        await self.conn.execute("""
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -176,34 +841,229 @@ async def init_db():
             quantity INTEGER NOT NULL,
             total_price REAL NOT NULL,
             date_ordered TEXT,
+            username TEXT,
+            item_name TEXT,
+            item_brand TEXT,
+            unit_price REAL,
             FOREIGN KEY (user_id) REFERENCES users(id),
             FOREIGN KEY (item_id) REFERENCES items(id)
         )
         """)
-        await db.conn.commit()
+        # Orders are read by user and by date, and archived by date
+        await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (date_ordered)")
+        await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, date_ordered)")
+        # Background jobs table, so bulk imports survive a restart
+        await self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            total INTEGER,
+            processed INTEGER NOT NULL DEFAULT 0,
+            succeeded INTEGER NOT NULL DEFAULT 0,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            date_created TEXT,
+            date_started TEXT,
+            date_finished TEXT,
+            owner TEXT,
+            heartbeat TEXT
+        )
+        """)
+        # Small key/value table for database-wide bookkeeping
+        await self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        """)
+        # In-stock counts per (category, facet, value) for /shop/facets, kept up to date by triggers on items
+        await self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS facet_counts (
+            category TEXT NOT NULL,
+            facet TEXT NOT NULL,
+            value TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (category, facet, value)
+        ) WITHOUT ROWID
+        """)
+        # Every item write from any worker, for the in-memory copies of items to catch up from
+        await self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS item_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_id INTEGER NOT NULL
+        )
+        """)
+        await self.conn.commit()
+        await setup_facets(self, self.logger)
+        await setup_item_changes(self)
+        await migrate_order_snapshots(self, self.logger)
+        await migrate_job_owners(self)
+        if os.path.exists(self.archive_name):
+            await self.attach_archive(create=True)
+            await migrate_order_snapshots(self, self.logger, "archive")
+
+
+
+async def lock_writes(db: SQLiteDatabase, table: str = "meta"):
+    """
+    Takes the write lock of the file `table` is in for the transaction `db` is in, waiting for it like any write.
+    Every worker runs the schema upgrades below on start, this makes them take turns from the first check on. Without
+    it a transaction that read first fails with "database is locked" once another worker's write got in before its own.
+    """
+    await db.conn.execute(f"DELETE FROM {table} WHERE 0")
+
+
+async def setup_facets(db: SQLiteDatabase, logger: Logger):
+    """
+    (Re)creates the facet triggers, and rebuilds `facet_counts` with one scan of `items` when the price buckets
+    changed since the last start, or the table has never been filled.
+    """
+    buckets = ",".join(f"{b:g}" for b in FACET_PRICE_BUCKETS)
+
+    async with db.transaction():
+        await lock_writes(db)
+        current = await db.get_meta("facet_price_buckets")
+        for kind in ("insert", "update", "delete"):
+            await db.conn.execute(f"DROP TRIGGER IF EXISTS items_facets_{kind}")
+        for trigger in _facet_triggers():
+            await db.conn.execute(trigger)
+
+        if current != buckets:
+            await db.conn.execute("DELETE FROM facet_counts")
+            for statement in _facet_rebuild():
+                await db.conn.execute(statement)
+            await db.set_meta(facet_price_buckets=buckets)
+            logger.info(f"Rebuilt facet counts for price buckets {buckets}")
+
+
+async def setup_item_changes(db: SQLiteDatabase):
+    """(Re)creates the `item_changes` triggers, and trims the table in case `ITEM_CHANGES_KEEP` went down."""
+    async with db.transaction():
+        await lock_writes(db)
+        for name in ("items_changes_insert", "items_changes_update", "items_changes_delete", "item_changes_prune"):
+            await db.conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        for trigger in _item_change_triggers():
+            await db.conn.execute(trigger)
+        await db.conn.execute(
+            "DELETE FROM item_changes WHERE seq <= (SELECT MAX(seq) FROM item_changes) - ?", (ITEM_CHANGES_KEEP,)
+        )
+
+
+async def migrate_order_snapshots(db: SQLiteDatabase, logger: Logger, schema: str = "main", batch_size: int = 1000):
+    """
+    Adds the snapshot columns to an `orders` table that predates them, and fills them in for existing orders.
+    Old orders can only get the user's and item's current names, that's the best there is.
+    """
+    await add_missing_columns(db, "orders", ORDER_SNAPSHOT_COLUMNS, schema)
+
+    if await db.get_meta(f"order_snapshots_backfilled_{schema}") == "1":
+        return
+
+    cur = await db.conn.execute(f"SELECT COALESCE(MAX(id), 0) AS last_id FROM {schema}.orders")
+    last_id = (await cur.fetchone())["last_id"]
+    filled = 0
+    for start in range(0, last_id, batch_size):
+        cur = await db.conn.execute(f"""
+            UPDATE {schema}.orders SET
+                username = (SELECT username FROM main.users WHERE users.id = orders.user_id),
+                item_name = (SELECT name FROM main.items WHERE items.id = orders.item_id),
+                item_brand = (SELECT brand FROM main.items WHERE items.id = orders.item_id),
+                unit_price = total_price / quantity
+            WHERE id > ? AND id <= ? AND username IS NULL
+        """, (start, start + batch_size))
+        filled += cur.get_cursor().rowcount
+
+    await db.set_meta(**{f"order_snapshots_backfilled_{schema}": "1"})
+    logger.info(f"Backfilled order snapshots for {filled} orders in {schema}")
+
+
+async def migrate_job_owners(db: SQLiteDatabase):
+    """Adds the owner and heartbeat columns to a `jobs` table that predates them."""
+    await add_missing_columns(db, "jobs", JOB_OWNER_COLUMNS)
+
+
+async def add_missing_columns(db: SQLiteDatabase, table: str, columns: Dict[str, str], schema: str = "main"):
+    """
+    Adds the `columns` (name to type) that `table` doesn't have yet. The check and the ALTERs happen under the write
+    lock, so of several workers starting together only the first adds them.
+    """
+    async with db.transaction():
+        await lock_writes(db, f"{schema}.{table}")
+        cur = await db.conn.execute(f"PRAGMA {schema}.table_info({table})")
+        existing = {row["name"] for row in await cur.fetchall()}
+        for column, kind in columns.items():
+            if column not in existing:
+                await db.conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {column} {kind}")
+
+
+def online_backup(source: sqlite3.Connection, path: str, pages: int, pause: float) -> datetime.datetime:
+    """
+    Copies the database behind `source` (an autocommit `sqlite3` connection) to `path` with SQLite's online backup API,
+    `pages` pages per step with a `pause` in between. This blocks, run it in a worker thread.
+
+    The copy runs inside one read transaction, which in WAL mode gives a consistent point in time without ever
+    blocking writers. Returns that point in time.
+    """
+    dest = sqlite3.connect(path)
+    began = False
+    try:
+        # Holding a read transaction across all the backup steps pins them to one snapshot of the WAL.
+        source.execute("BEGIN")
+        began = True
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        taken_at = datetime.datetime.now(datetime.timezone.utc)
+        source.backup(dest, pages=pages, progress=lambda *_: time.sleep(pause))
+    finally:
+        try:
+            # Only the transaction started here, a failed BEGIN has nothing to end and COMMIT would hide why it failed.
+            if began:
+                source.execute("COMMIT")
+        finally:
+            dest.close()
+    return taken_at
+
+
+def open_db(logger: Logger) -> APIDatabase:
+    """A database of the configured backend, use it with `async with`."""
+    if DATABASE_BACKEND == "postgres":
+        from postgres import PostgresDatabase
+        return PostgresDatabase(logger)
+    return SQLiteDatabase(logger)
+
+
+async def init_db():
+    logger = Logger("api.log")
+    async with open_db(logger) as db:
+        await db.create_schema()
 
         # This is for temporary testing since an admin doesn't exist when there is no DB
-        cur = await db.conn.execute("SELECT COUNT(*) as count FROM admins")
-        row = await cur.fetchone()
+        row = await db._fetchrow("SELECT COUNT(*) as count FROM admins")
         if row["count"] == 0:
             pw_hash = hash_password("adminpass")
-            await db.conn.execute(
-                "INSERT INTO admins (username, password_hash) VALUES (?, ?)",
+            await db._execute(
+                "INSERT INTO admins (username, password_hash) VALUES (?, ?) ON CONFLICT (username) DO NOTHING",
                 ("shopkeeper", pw_hash)
             )
-            await db.conn.commit()
+            await db.commit()
             logger.info("Preloaded default admin: shopkeeper/adminpass")
 
     logger.info("Database initialized successfully.")
 
 
+async def close_db():
+    """Releases whatever the backend holds on to between requests, called on shutdown."""
+    if DATABASE_BACKEND == "postgres":
+        from postgres import close_pool
+        await close_pool()
+
+
 logger = Logger("api.log", True)
 
 
 # This is a pretty cool feature of FastAPI, you can have a Depends() thing and it executes code on it's own
 # to prevent the passing of connections and trying to maintain database connection throughout multiple files.
 async def get_db():
-    async with APIDatabase(logger=logger) as db:
+    async with open_db(logger=logger) as db:
         yield db
-
-
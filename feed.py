@@ -0,0 +1,210 @@
+from typing import (
+    AsyncIterator,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import asyncio
+import collections
+import json
+import os
+import time
+
+from fastapi import Request
+
+from changes import GAP_TIMEOUT
+from database import APIDatabase, item_listeners, open_db
+from logger import Logger
+
+FEED_BUFFER_SIZE = int(os.getenv("FEED_BUFFER_SIZE", "10000"))
+FEED_KEEPALIVE = float(os.getenv("FEED_KEEPALIVE", "15"))
+# Seconds between looks at `item_changes` for writes made by other workers. This worker's own writes go out at once.
+FEED_POLL_INTERVAL = float(os.getenv("FEED_POLL_INTERVAL", "0.5"))
+# Seconds the feed holds changes back behind a hole in the `item_changes` numbering, before taking the hole for a
+# write that was rolled back. Only Postgres has such holes, a write there can commit after a later numbered one.
+FEED_GAP_WAIT = float(os.getenv("FEED_GAP_WAIT", "2"))
+
+# What each stream gets to see of an item change. The storefront doesn't need exact stock levels.
+PUBLIC_FIELDS = ("seq", "item_id", "price", "in_stock")
+ADMIN_FIELDS = ("seq", "item_id", "name", "price", "quantity", "in_stock")
+
+
+class ChangeFeed:
+    """
+    A feed of item changes for dashboards and caches to follow instead of polling.
+
+    The publisher task follows `item_changes`, which triggers append to on every item write from any worker, reads the
+    changed items' current state in one query and appends one event per item to a bounded ring buffer. Event ids are
+    `item_changes` sequence numbers, the same in every worker, so a client can resume on whichever worker it reaches.
+    A client resuming from further back than the buffer (or the table) goes, is told to reset instead of silently
+    missing events.
+    """
+
+    def __init__(self, logger: Logger, size: int = FEED_BUFFER_SIZE):
+        self.logger = logger
+        self.events: Deque[Dict] = collections.deque(maxlen=size)
+        # The newest change published, and the oldest point a client can still resume from.
+        self.seq = 0
+        self.floor = 0
+        # Events are also numbered in the order they were published, which is what live streams follow.
+        self.position = 0
+        self.resets = 0
+        self.gap_since: Optional[float] = None
+        self.skipped: Dict[int, float] = {}
+        self._wake = asyncio.Event()
+        self._new_events = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def mark_changed(self, item_ids: Set[int]):
+        self._wake.set()
+
+    async def start(self):
+        async with open_db(self.logger) as db:
+            self.seq = self.floor = (await db.item_change_bounds())["last"]
+        self._task = asyncio.create_task(self._publish_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _publish_loop(self):
+        while True:
+            try:
+                async with open_db(self.logger) as db:
+                    while True:
+                        await self._publish(db)
+                        try:
+                            await asyncio.wait_for(self._wake.wait(), FEED_POLL_INTERVAL)
+                        except asyncio.TimeoutError:
+                            pass
+                        self._wake.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Change feed publisher failed: {e}")
+                await asyncio.sleep(1)
+
+    def _notify(self):
+        # Wake up every stream that is waiting, and give the next batch a fresh event to wait on.
+        self._new_events.set()
+        self._new_events = asyncio.Event()
+
+    def _reset(self, seq: int):
+        """Starts over from `seq`, every client is told to reset."""
+        self.events.clear()
+        self.seq = self.floor = seq
+        self.resets += 1
+        self.gap_since = None
+        self.skipped = {}
+        self._notify()
+
+    async def _publish(self, db: APIDatabase):
+        bounds = await db.item_change_bounds()
+        if bounds["first"] > self.seq + 1 or bounds["last"] - self.seq > self.events.maxlen:
+            self.logger.info(f"Change feed fell behind at {self.seq}, subscribers are told to reset")
+            self._reset(bounds["last"])
+            return
+
+        now = time.monotonic()
+        self.skipped = {seq: since for seq, since in self.skipped.items() if now - since < GAP_TIMEOUT}
+        if bounds["last"] <= self.seq and not self.skipped:
+            return
+
+        ready: List[Dict] = []
+        for row in await db.item_changes(self.seq, list(self.skipped)):
+            seq = row["seq"]
+            if seq <= self.seq:
+                # A write that committed after the feed had moved past its number, send it late rather than never.
+                self.skipped.pop(seq, None)
+            else:
+                if seq > self.seq + 1:
+                    if self.gap_since is None:
+                        self.gap_since = now
+                    if now - self.gap_since < FEED_GAP_WAIT:
+                        break
+                    self.skipped.update((missing, now) for missing in range(self.seq + 1, seq))
+                self.gap_since = None
+                self.seq = seq
+            ready.append(row)
+
+        if not ready:
+            return
+        # One event per item, numbered by its last change, the state read below is newer than any earlier one.
+        latest = {row["item_id"]: row["seq"] for row in ready}
+        rows = await db.fetch_items(("id", "name", "price", "quantity"), sorted(latest))
+        for row in sorted(rows, key=lambda row: latest[row["id"]]):
+            if len(self.events) == self.events.maxlen:
+                self.floor = self.events[0]["seq"]
+            self.position += 1
+            self.events.append({
+                "seq": latest[row["id"]],
+                "position": self.position,
+                "item_id": row["id"],
+                "name": row["name"],
+                "price": row["price"],
+                "quantity": row["quantity"],
+                "in_stock": row["quantity"] > 0,
+            })
+        self._notify()
+
+    def _resume_position(self, seq: int) -> Optional[int]:
+        """Where a client that saw everything up to event id `seq` carries on, None if it missed events."""
+        if seq > self.seq or seq < self.floor:
+            return None
+        for event in reversed(self.events):
+            if event["seq"] <= seq:
+                return event["position"]
+        return self.position - len(self.events)
+
+    def _after(self, position: int) -> List[Dict]:
+        """Events published after `position`, which must still be in the buffer."""
+        start = position - (self.position - len(self.events))
+        return [self.events[i] for i in range(start, len(self.events))]
+
+    async def stream(self, request: Request, last_seq: Optional[int], fields: Tuple[str, ...]) -> AsyncIterator[str]:
+        """Server-Sent Events for `fields` of every change after `last_seq` (or from now on), until the client leaves."""
+        # A client coming over from another worker may be a moment ahead of this one, give it time to catch up.
+        deadline = time.monotonic() + FEED_GAP_WAIT + FEED_POLL_INTERVAL
+        while last_seq is not None and last_seq > self.seq and time.monotonic() < deadline:
+            self._wake.set()
+            await asyncio.sleep(FEED_POLL_INTERVAL / 5)
+
+        position = self.position if last_seq is None else self._resume_position(last_seq)
+        resets = self.resets
+
+        while not await request.is_disconnected():
+            if position is None or resets != self.resets or position < self.position - len(self.events):
+                # The client has to refetch everything it caches, then follow on from here.
+                position, resets = self.position, self.resets
+                yield f"id: {self.seq}\nevent: reset\ndata: {json.dumps({'seq': self.seq})}\n\n"
+                continue
+
+            events = self._after(position)
+            for event in events:
+                position = event["position"]
+                data = json.dumps({field: event[field] for field in fields})
+                yield f"id: {event['seq']}\nevent: item\ndata: {data}\n\n"
+
+            if not events:
+                try:
+                    await asyncio.wait_for(self._new_events.wait(), FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+
+
+change_feed = ChangeFeed(Logger("feed"))
+item_listeners.append(change_feed.mark_changed)
+
+
+def parse_last_event_id(since: Optional[int], last_event_id: Optional[str]) -> Optional[int]:
+    """Browsers resume with the `Last-Event-ID` header, other clients can pass `since` instead."""
+    if since is not None:
+        return since
+    if last_event_id and last_event_id.isdigit():
+        return int(last_event_id)
+    return None
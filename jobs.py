@@ -0,0 +1,267 @@
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+)
+
+import asyncio
+import csv
+import datetime
+import os
+import secrets
+import socket
+
+from fastapi import UploadFile
+
+from database import APIDatabase, open_db
+from logger import Logger
+
+UPLOADS_DIR = os.getenv("JOB_UPLOADS_DIR", "uploads")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_CHUNK_SIZE = int(os.getenv("JOB_CHUNK_SIZE", "500"))
+JOB_CHUNK_PAUSE = float(os.getenv("JOB_CHUNK_PAUSE", "0.01"))
+# A running job whose runner hasn't committed a chunk for this many seconds is taken over by another runner.
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "60"))
+
+# These are the states a job can end up in, nothing moves a job out of one of these.
+FINISHED_STATUSES = ("completed", "failed", "cancelled")
+
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def _stale_before() -> str:
+    return (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=JOB_STALE_AFTER)).isoformat()
+
+
+class JobInterrupted(Exception):
+    """The job was cancelled or taken over by another runner since its last chunk, the current chunk is rolled back."""
+
+
+def _parse_new_item(row: Dict[str, str]) -> tuple | None:
+    """Turns a `bulk_new` CSV row into an `items` row, or None if the row should be skipped."""
+    try:
+        quantity = int(row["quantity"])
+        price = float(row["price"])
+    except Exception:
+        return None
+    if not row.get("name") or quantity < 0 or price < 0:
+        return None
+    return (
+        row["name"],
+        row.get("brand", ""),
+        row.get("description", ""),
+        row.get("category", ""),
+        quantity,
+        price,
+    )
+
+
+def _parse_restock(row: Dict[str, str]) -> tuple | None:
+    """Turns a `bulk_restock` CSV row into an `(item_id, quantity)` pair, or None if the row should be skipped."""
+    try:
+        item_id = int(row["item_id"])
+        quantity = int(row["quantity"])
+    except Exception:
+        return None
+    if quantity <= 0:
+        return None
+    return (item_id, quantity)
+
+
+class JobRunner:
+    """
+    Runs bulk inventory imports in the background so the HTTP request only has to spool the upload.
+
+    Jobs are stored in the `jobs` table and every chunk commits its rows together with the job's progress,
+    so a restart picks a job back up from the last committed chunk instead of redoing (or losing) work.
+
+    Every worker process has a runner, and any of them may pick up any job: a runner first claims the job in the
+    table, and every chunk only commits while the job is still `running` and still claimed by that runner. A cancel
+    handled by another worker, or a takeover after this runner stopped heartbeating, rolls the chunk back instead.
+    """
+
+    def __init__(self, logger: Logger, workers: int = JOB_WORKERS, chunk_size: int = JOB_CHUNK_SIZE):
+        self.logger = logger
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        self.queued: Set[str] = set()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        os.makedirs(UPLOADS_DIR, exist_ok=True)
+        async with open_db(self.logger) as db:
+            await self._recover(db)
+
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._recover_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Jobs that are cut off here go back in the queue, so the next runner to look resumes them straight away.
+        async with open_db(self.logger) as db:
+            await db.release_jobs(self.owner)
+
+    def _enqueue(self, job_id: str):
+        if job_id not in self.queued:
+            self.queued.add(job_id)
+            self.queue.put_nowait(job_id)
+
+    async def _recover(self, db: APIDatabase):
+        """Queues jobs no runner is working on: queued ones, and ones whose runner stopped heartbeating."""
+        stale_before = _stale_before()
+        for job in await db.list_jobs("queued", "running", "cancelling"):
+            stale = job["heartbeat"] is None or job["heartbeat"] < stale_before
+            if job["status"] == "cancelling":
+                # Its runner is gone, there's nobody left to stop at the next chunk.
+                if stale:
+                    await self._finish(db, job, "cancelled", if_status=("cancelling",))
+            elif job["status"] == "queued" or stale:
+                self._enqueue(job["id"])
+
+    async def _recover_loop(self):
+        while True:
+            await asyncio.sleep(JOB_STALE_AFTER / 2)
+            try:
+                async with open_db(self.logger) as db:
+                    await self._recover(db)
+            except Exception as e:
+                self.logger.error(f"Looking for abandoned jobs failed: {e}")
+
+    async def submit(self, db: APIDatabase, kind: str, file: UploadFile) -> str:
+        """Spools the upload to disk, records the job and queues it. Returns the job id."""
+        job_id = secrets.token_hex(8)
+        file_path = os.path.join(UPLOADS_DIR, f"{job_id}.csv")
+        os.makedirs(UPLOADS_DIR, exist_ok=True)
+        with open(file_path, "wb") as f:
+            while chunk := await file.read(1 << 16):
+                f.write(chunk)
+
+        await db.create_job(job_id, kind, file_path)
+        self._enqueue(job_id)
+        return job_id
+
+    async def cancel(self, db: APIDatabase, job: Dict) -> str:
+        """
+        Cancels a job. A queued job is cancelled right away, a running one stops after its current chunk,
+        whichever worker runs it. Returns the job's new status.
+        """
+        if await self._finish(db, job, "cancelled", if_status=("queued",)):
+            return "cancelled"
+        if await db.update_job(job["id"], if_status=("running",), status="cancelling"):
+            return "cancelling"
+        # It finished (or was claimed and then finished) in the meantime.
+        current = await db.get_job(job["id"])
+        return current["status"] if current else job["status"]
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            self.queued.discard(job_id)
+            try:
+                async with open_db(self.logger) as db:
+                    await self._run(db, job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Job {job_id} failed: {e}")
+                try:
+                    async with open_db(self.logger) as db:
+                        job = await db.get_job(job_id)
+                        if job:
+                            await self._finish(db, job, "failed", error=str(e), if_owner=self.owner)
+                except Exception as e:
+                    # Left running, so it's picked up again once its heartbeat goes stale. The worker carries on.
+                    self.logger.error(f"Could not mark job {job_id} as failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _run(self, db: APIDatabase, job_id: str):
+        if not await db.claim_job(job_id, self.owner, _stale_before()):
+            # Finished, cancelled, or another runner has it.
+            return
+        job = await db.get_job(job_id)
+        if job["processed"]:
+            self.logger.info(f"Resuming job {job_id} ({job['kind']}) from row {job['processed']}")
+
+        with open(job["file_path"], newline="", encoding="utf-8") as f:
+            total = sum(1 for _ in csv.DictReader(f))
+
+        await db.update_job(job_id, if_owner=self.owner, total=total)
+
+        if job["kind"] == "bulk_new":
+            parse, apply = _parse_new_item, db.create_items
+        else:
+            parse, apply = _parse_restock, db.restock_items
+
+        processed: int = job["processed"]
+        succeeded: int = job["succeeded"]
+        skipped: int = job["skipped"]
+
+        try:
+            with open(job["file_path"], newline="", encoding="utf-8") as f:
+                reader = csv.DictReader(f)
+                # Rows before `processed` were committed by an earlier run of this job.
+                for _ in range(processed):
+                    next(reader, None)
+
+                while True:
+                    chunk = [row for _, row in zip(range(self.chunk_size), reader)]
+                    if not chunk:
+                        break
+
+                    rows = [r for r in map(parse, chunk) if r is not None]
+                    async with db.transaction():
+                        done = await apply(rows)
+                        # Checks the job's status in the same transaction, so a chunk can't land after a cancel.
+                        if not await db.update_job(
+                            job_id, if_status=("running",), if_owner=self.owner, heartbeat=_now(),
+                            processed=processed + len(chunk), succeeded=succeeded + done,
+                            skipped=skipped + len(chunk) - done,
+                        ):
+                            raise JobInterrupted()
+                    processed += len(chunk)
+                    succeeded += done
+                    skipped += len(chunk) - done
+
+                    # Give live requests a turn at the database writer between chunks.
+                    await asyncio.sleep(JOB_CHUNK_PAUSE)
+
+            if not await self._finish(db, job, "completed", if_status=("running",), if_owner=self.owner):
+                raise JobInterrupted()
+        except JobInterrupted:
+            current = await db.get_job(job_id)
+            if current and current["status"] == "cancelling":
+                await self._finish(db, job, "cancelled", if_status=("cancelling",))
+                self.logger.info(f"Job {job_id} cancelled after {processed} rows")
+            else:
+                self.logger.info(f"Job {job_id} was taken over by another runner")
+            return
+
+        self.logger.info(f"Job {job_id} completed: {succeeded} rows applied, {skipped} skipped")
+
+    async def _finish(
+        self, db: APIDatabase, job: Dict, status: str, error: Optional[str] = None,
+        if_status: Sequence[str] = (), if_owner: Optional[str] = None,
+    ) -> bool:
+        """Moves the job to a finished status (under the same conditions as `update_job`) and drops its upload."""
+        if not await db.update_job(
+            job["id"], if_status=if_status, if_owner=if_owner, status=status, error=error, date_finished=_now()
+        ):
+            return False
+        try:
+            os.remove(job["file_path"])
+        except FileNotFoundError:
+            pass
+        return True
+
+
+job_runner = JobRunner(Logger("jobs"))
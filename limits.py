@@ -0,0 +1,197 @@
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Optional,
+    Tuple,
+)
+
+import math
+import os
+import time
+from urllib.parse import parse_qs
+
+from fastapi.responses import JSONResponse
+
+from logger import Logger
+from routes.auth import sessions
+
+# Per route group `prefix=rate:burst`, rate in requests per second. Each token (or client IP) gets its own bucket.
+RATE_LIMITS = os.getenv("RATE_LIMITS", "/auth=1:5,/cart=10:30,/orders=5:15")
+# Buckets kept per route group, the least recently seen clients are forgotten past this.
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "50000"))
+# Past these many requests (or writes) in flight, new ones are turned away with a 503 straight away.
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "200"))
+MAX_WRITES_IN_FLIGHT = int(os.getenv("MAX_WRITES_IN_FLIGHT", "32"))
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "1"))
+# Change streams stay open, so they are capped by how many are open at once rather than counted as in flight.
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", "500"))
+MAX_STREAMS_PER_CLIENT = int(os.getenv("MAX_STREAMS_PER_CLIENT", "5"))
+
+# Only small form bodies are read to find a `token` field, anything else is limited by client IP.
+MAX_FORM_PEEK = 4096
+WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+# Requests here come before there's a session (logging in, signing up), they are always limited by client IP.
+IP_KEYED_PREFIXES = ("/auth",)
+
+
+class RateLimiter:
+    """
+    Token buckets for one route group. Each bucket is just a `(tokens, last_seen)` tuple in a dict kept in
+    least-recently-seen order, so memory stays bounded by `max_keys` no matter how many clients show up.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+
+    def acquire(self, key: str, now: float) -> float:
+        """Takes a token for `key`. Returns 0 if there was one, otherwise the seconds until there will be."""
+        tokens, last_seen = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last_seen) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            del self.buckets[next(iter(self.buckets))]
+        return wait
+
+
+def parse_rate_limits(config: str) -> Dict[str, RateLimiter]:
+    limiters = {}
+    for entry in filter(None, (part.strip() for part in config.split(","))):
+        prefix, limit = entry.split("=")
+        rate, burst = limit.split(":")
+        limiters[prefix] = RateLimiter(float(rate), float(burst))
+    return limiters
+
+
+class AdmissionControl:
+    """
+    ASGI middleware that protects the app under overload.
+
+    It sheds load first: while too many requests, or too many writes queued up for the single SQLite writer, are in
+    flight, new ones get a fast 503 with `Retry-After`. Then the route group's rate limit applies, per session token
+    (from the `Authorization` header or a `token` form field) or per client IP, answering 429 with `Retry-After`.
+    Only a token that belongs to a live session counts, a made up one would otherwise get a fresh bucket every time.
+    Change streams are long lived, so instead of being counted as in flight they have their own cap on how many are
+    open at once, in total and per client IP.
+    """
+
+    def __init__(self, app: Callable[..., Awaitable[Any]]):
+        self.app = app
+        self.logger = Logger("limits")
+        self.limiters = parse_rate_limits(RATE_LIMITS)
+        self.in_flight = 0
+        self.writes_in_flight = 0
+        self.streams: Dict[str, int] = {}
+        self.streams_open = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["path"].endswith("/changes"):
+            await self._stream(scope, receive, send)
+            return
+
+        is_write = scope["method"] in WRITE_METHODS
+        if self.in_flight >= MAX_IN_FLIGHT or (is_write and self.writes_in_flight >= MAX_WRITES_IN_FLIGHT):
+            await self._reject(scope, receive, send, 503, "Server is busy, try again shortly", SHED_RETRY_AFTER)
+            return
+
+        limiter = self._limiter_for(scope["path"])
+        if limiter is not None:
+            key, receive = await self._client_key(scope, receive)
+            wait = limiter.acquire(key, time.monotonic())
+            if wait:
+                await self._reject(scope, receive, send, 429, "Too many requests", math.ceil(wait))
+                return
+
+        self.in_flight += 1
+        self.writes_in_flight += is_write
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+            self.writes_in_flight -= is_write
+
+    async def _stream(self, scope, receive, send):
+        client = self._client_ip(scope)
+        if self.streams_open >= MAX_STREAMS or self.streams.get(client, 0) >= MAX_STREAMS_PER_CLIENT:
+            await self._reject(scope, receive, send, 503, "Too many open change streams", SHED_RETRY_AFTER)
+            return
+
+        self.streams_open += 1
+        self.streams[client] = self.streams.get(client, 0) + 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.streams_open -= 1
+            self.streams[client] -= 1
+            if not self.streams[client]:
+                del self.streams[client]
+
+    def _limiter_for(self, path: str) -> Optional[RateLimiter]:
+        for prefix, limiter in self.limiters.items():
+            if path.startswith(prefix):
+                return limiter
+        return None
+
+    async def _client_key(self, scope, receive) -> Tuple[str, Callable[[], Awaitable[Dict]]]:
+        """
+        Works out who is asking. If the form body had to be read for that, the returned `receive` replays it to the app.
+        """
+        if scope["path"].startswith(IP_KEYED_PREFIXES):
+            return self._client_ip(scope), receive
+
+        headers = dict(scope["headers"])
+        authorization = headers.get(b"authorization", b"").decode("latin-1")
+        if authorization.startswith("Bearer ") and authorization[7:] in sessions:
+            return f"token:{authorization[7:]}", receive
+
+        content_type = headers.get(b"content-type", b"")
+        content_length = headers.get(b"content-length", b"")
+        if (
+            content_type.startswith(b"application/x-www-form-urlencoded")
+            and content_length.isdigit()
+            and int(content_length) <= MAX_FORM_PEEK
+        ):
+            body = b""
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get("body", b"")
+                more_body = message.get("more_body", False)
+
+            replayed = False
+
+            async def replay() -> Dict:
+                nonlocal replayed
+                if not replayed:
+                    replayed = True
+                    return {"type": "http.request", "body": body, "more_body": False}
+                return await receive()
+
+            token = parse_qs(body.decode("latin-1")).get("token")
+            if token and token[0] in sessions:
+                return f"token:{token[0]}", replay
+            receive = replay
+
+        return self._client_ip(scope), receive
+
+    @staticmethod
+    def _client_ip(scope) -> str:
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'unknown'}"
+
+    async def _reject(self, scope, receive, send, status: int, detail: str, retry_after: int):
+        response = JSONResponse({"detail": detail}, status_code=status, headers={"Retry-After": str(retry_after)})
+        await response(scope, receive, send)
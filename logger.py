@@ -2,6 +2,8 @@ from typing import Optional, Literal, Dict, Union
 import os
 import datetime
 
+from tracing import span
+
 
 class Logger:
     def __init__(self, name: str, console: Optional[bool] = False):
@@ -30,13 +32,14 @@ class Logger:
         ] = "debug",
     ) -> None:
         assert level is not None
-        fmt: str = f"{datetime.datetime.now().strftime('%d/%m %H:%M:%S')}[{self.name.upper()}] {level.upper()}: {message}\n"
-        self.to_file(fmt)
-        if self.console:
-            thing = self.name
-            type = self.LEVEL_COLORS.get(level, "[0;1;35m{}[0m").format(level.upper())
-            time = datetime.datetime.now(datetime.UTC).strftime("%d/%m %H:%M:%S")
-            print(f"{thing} | {type} {time} {message}")
+        with span("logging"):
+            fmt: str = f"{datetime.datetime.now().strftime('%d/%m %H:%M:%S')}[{self.name.upper()}] {level.upper()}: {message}\n"
+            self.to_file(fmt)
+            if self.console:
+                thing = self.name
+                type = self.LEVEL_COLORS.get(level, "[0;1;35m{}[0m").format(level.upper())
+                time = datetime.datetime.now(datetime.UTC).strftime("%d/%m %H:%M:%S")
+                print(f"{thing} | {type} {time} {message}")
 
     def info(
         self,
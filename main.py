@@ -1,16 +1,39 @@
 from fastapi import FastAPI
 from contextlib import asynccontextmanager
 
-from database import init_db
+from analytics import analytics_snapshot
+from archive import order_archiver
+from database import close_db, init_db
+from feed import change_feed
+from jobs import job_runner
+from maintenance import maintenance
+from limits import AdmissionControl
+from profiler import ProfilingMiddleware, TracedJSONResponse
 from routes import auth, inventory, shop, orders, cart  
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    await job_runner.start()
+    await change_feed.start()
+    if analytics_snapshot is not None:
+        await analytics_snapshot.start()
+    await order_archiver.start()
+    await maintenance.start()
     yield
+    await maintenance.stop()
+    await order_archiver.stop()
+    if analytics_snapshot is not None:
+        await analytics_snapshot.stop()
+    await change_feed.stop()
+    await job_runner.stop()
+    await close_db()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=TracedJSONResponse)
+# Inside admission control, so requests it sheds don't count towards a profile.
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(AdmissionControl)
 
 
 app.include_router(auth.router)
@@ -0,0 +1,407 @@
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+
+import asyncio
+import datetime
+import glob
+import json
+import os
+import secrets
+import socket
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
+from database import ARCHIVE_DB_PATH, DATABASE_BACKEND, DB_PATH, online_backup
+from logger import Logger
+
+# Seconds between scheduled maintenance passes.
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "86400"))
+# UTC hours `start-end` (e.g. `2-5`) that scheduled passes and backups may start in. Unset, any time will do.
+MAINTENANCE_WINDOW = os.getenv("MAINTENANCE_WINDOW")
+# A pass also runs early, window or not, once this many item writes happened or this much of the file is free pages.
+MAINTENANCE_WRITE_THRESHOLD = int(os.getenv("MAINTENANCE_WRITE_THRESHOLD", "50000"))
+MAINTENANCE_FREE_BYTES = int(os.getenv("MAINTENANCE_FREE_BYTES", str(64 << 20)))
+MAINTENANCE_VACUUM_PAGES = int(os.getenv("MAINTENANCE_VACUUM_PAGES", "512"))
+MAINTENANCE_PAUSE = float(os.getenv("MAINTENANCE_PAUSE", "0.05"))
+# Seconds between online backups. Unset, backups only happen through `POST /inventory/backup`.
+BACKUP_INTERVAL = os.getenv("BACKUP_INTERVAL")
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "1024"))
+BACKUP_PAUSE = float(os.getenv("BACKUP_PAUSE", "0.005"))
+
+# How often the scheduler looks at the write counter, the free pages and the clock.
+CHECK_INTERVAL = 60
+# Seconds a worker's claim on running maintenance lasts, it is renewed well before then while a pass or backup runs.
+LEASE_SECONDS = 300
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class MaintenanceBusy(Exception):
+    """Another worker process is running a maintenance pass or a backup right now."""
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+class MaintenanceScheduler:
+    """
+    Keeps the SQLite file in shape: fresh planner statistics, free pages handed back to the file system, a short WAL,
+    and optionally consistent online backups.
+
+    A pass runs every `MAINTENANCE_INTERVAL` inside `MAINTENANCE_WINDOW`, or straight away once the item writes since
+    the last pass or the free pages in the file cross their thresholds (after a bulk import or an archiving run).
+    No step holds the write lock for long: ANALYZE only samples each index, free pages go back a few hundred at a time
+    with incremental vacuum, and the checkpoint gives up instead of waiting on readers.
+
+    Every worker process runs a scheduler, but only one pass or backup runs at a time across all of them: the worker
+    doing it holds a lease in `meta`, like a runner's claim on a job. The write count, the last reports and with them
+    the schedule live in `meta` too, so every worker sees the same ones.
+    """
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self.lock = asyncio.Lock()
+        self.db_name = os.getenv("DATABASE_NAME", DB_PATH)
+        self.archive_name = os.getenv("ARCHIVE_DATABASE_NAME", ARCHIVE_DB_PATH)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        self._started_at = _now()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if DATABASE_BACKEND != "sqlite":
+            self.logger.info("Database maintenance is left to PostgreSQL's autovacuum")
+            return
+        self._started_at = _now()
+        await asyncio.to_thread(self._start_counting)
+        self._task = asyncio.create_task(self._maintenance_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def _in_window(self) -> bool:
+        if not MAINTENANCE_WINDOW:
+            return True
+        start, end = (int(hour) for hour in MAINTENANCE_WINDOW.split("-"))
+        hour = _now().hour
+        return start <= hour < end if start <= end else hour >= start or hour < end
+
+    def _seconds_since(self, report: Optional[Dict[str, Any]]) -> float:
+        finished = datetime.datetime.fromisoformat(report["finished_at"]) if report else self._started_at
+        return (_now() - finished).total_seconds()
+
+    def _pass_reason(self) -> Optional[str]:
+        """Why a maintenance pass is due now, or None if it isn't."""
+        writes = self._item_writes()
+        free = self._free_bytes()
+        if writes >= MAINTENANCE_WRITE_THRESHOLD:
+            return f"{writes} item writes"
+        if free >= MAINTENANCE_FREE_BYTES:
+            return f"{free} free bytes"
+        if self._seconds_since(self._report("maintenance_last_run")) >= MAINTENANCE_INTERVAL and self._in_window():
+            return "schedule"
+        return None
+
+    def _backup_due(self) -> bool:
+        return (
+            bool(BACKUP_INTERVAL)
+            and self._seconds_since(self._report("maintenance_last_backup")) >= float(BACKUP_INTERVAL)
+            and self._in_window()
+        )
+
+    async def _maintenance_loop(self):
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL)
+            try:
+                # Looked at before and again after taking the lease: the first look costs no write, the second makes
+                # sure another worker didn't just do it.
+                if await asyncio.to_thread(self._pass_reason):
+                    async with self._leased():
+                        if reason := await asyncio.to_thread(self._pass_reason):
+                            await self._run(reason, False)
+
+                if await asyncio.to_thread(self._backup_due):
+                    async with self._leased():
+                        if await asyncio.to_thread(self._backup_due):
+                            await self._backup()
+            except MaintenanceBusy:
+                pass
+            except Exception as e:
+                self.logger.error(f"Database maintenance failed: {e}")
+
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_name, isolation_level=None, check_same_thread=False)
+        return self._conn
+
+    def _execute(self, query: str, params: Sequence[Any] = ()) -> int:
+        """
+        Runs one statement on a short-lived connection of its own, so it never lands inside a step running on the
+        scheduler's connection in another thread. Returns how many rows it changed.
+        """
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
+        try:
+            return conn.execute(query, tuple(params)).rowcount
+        finally:
+            conn.close()
+
+    def _fetchone(self, query: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        conn = sqlite3.connect(self.db_name, isolation_level=None)
+        try:
+            return conn.execute(query, tuple(params)).fetchone()
+        finally:
+            conn.close()
+
+    def _report(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._fetchone("SELECT value FROM meta WHERE key = ?", (key,))
+        return json.loads(row[0]) if row else None
+
+    def _item_seq(self) -> int:
+        """The sequence number of the newest `item_changes` row ever written, by any worker. Pruning doesn't lower it."""
+        row = self._fetchone("SELECT seq FROM sqlite_sequence WHERE name = 'item_changes'")
+        return row[0] if row else 0
+
+    def _start_counting(self):
+        """Item writes are counted from here the first time any worker starts, from the last pass after that."""
+        self._execute(
+            "INSERT INTO meta (key, value) VALUES ('maintenance_item_seq', ?) ON CONFLICT (key) DO NOTHING",
+            (str(self._item_seq()),)
+        )
+
+    def _item_writes(self) -> int:
+        """Item writes, by every worker, since the last pass."""
+        row = self._fetchone("SELECT value FROM meta WHERE key = 'maintenance_item_seq'")
+        return max(self._item_seq() - int(row[0]), 0) if row else 0
+
+    def _claim_lease(self) -> bool:
+        """Takes (or renews) the maintenance lease, unless another worker holds one that hasn't expired."""
+        now = _now()
+        expires = (now + datetime.timedelta(seconds=LEASE_SECONDS)).isoformat()
+        # The value is `<expires> <owner>`, so comparing it with the current time tells whether it expired.
+        return self._execute(
+            "INSERT INTO meta (key, value) VALUES ('maintenance_lease', ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value "
+            "WHERE meta.value < ? OR substr(meta.value, instr(meta.value, ' ') + 1) = ?",
+            (f"{expires} {self.owner}", now.isoformat(), self.owner)
+        ) > 0
+
+    def _release_lease(self):
+        self._execute(
+            "DELETE FROM meta WHERE key = 'maintenance_lease' AND substr(value, instr(value, ' ') + 1) = ?",
+            (self.owner,)
+        )
+
+    async def _renew_lease(self):
+        while True:
+            await asyncio.sleep(LEASE_SECONDS / 3)
+            if not await asyncio.to_thread(self._claim_lease):
+                self.logger.error("Lost the maintenance lease, another worker may start maintenance alongside")
+
+    @asynccontextmanager
+    async def _leased(self) -> AsyncIterator[None]:
+        """Runs the block as the one worker doing maintenance. Raises `MaintenanceBusy` if another one is."""
+        async with self.lock:
+            if not await asyncio.to_thread(self._claim_lease):
+                raise MaintenanceBusy()
+            renew = asyncio.create_task(self._renew_lease())
+            try:
+                yield
+            finally:
+                renew.cancel()
+                await asyncio.gather(renew, return_exceptions=True)
+                await asyncio.to_thread(self._release_lease)
+
+    async def status(self) -> Dict[str, Any]:
+        """The item writes since the last pass and the reports of the last pass and backup, whichever worker ran them."""
+        if DATABASE_BACKEND != "sqlite":
+            return {"item_writes": 0, "last_run": None, "last_backup": None}
+        return {
+            "item_writes": await asyncio.to_thread(self._item_writes),
+            "last_run": await asyncio.to_thread(self._report, "maintenance_last_run"),
+            "last_backup": await asyncio.to_thread(self._report, "maintenance_last_backup"),
+        }
+
+    def _free_bytes(self) -> int:
+        conn = self._connection()
+        return conn.execute("PRAGMA freelist_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+    def _analyze(self, full: bool):
+        conn = self._connection()
+        if full:
+            # Sampled, so it costs a few page reads per index rather than a scan of every table.
+            conn.execute("PRAGMA analysis_limit = 1000")
+            conn.execute("ANALYZE")
+        # 0x10002: look at every table, not only the ones this connection happened to query.
+        conn.execute("PRAGMA optimize = 0x10002")
+
+    def _vacuum_step(self) -> int:
+        """Frees up to `MAINTENANCE_VACUUM_PAGES` pages in one short write transaction, returns how many it freed."""
+        conn = self._connection()
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free or conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+        # `execute` would only step the pragma once, which frees a single page. `executescript` runs it to the end.
+        conn.executescript(f"PRAGMA incremental_vacuum({MAINTENANCE_VACUUM_PAGES})")
+        return free - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def _switch_auto_vacuum(self) -> bool:
+        """
+        Switches the file to incremental auto-vacuum, which takes one full VACUUM. That rewrites the whole file and
+        blocks every writer until it is done, so it only runs when asked for. Returns whether it had to.
+        """
+        conn = self._connection()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+
+    def _checkpoint(self) -> Dict[str, int]:
+        """Copies the WAL into the database file and truncates it, unless a reader is still using it."""
+        conn = self._connection()
+        # A truncating checkpoint waits for readers while holding the writer lock, so don't let it wait long.
+        conn.execute("PRAGMA busy_timeout = 100")
+        try:
+            busy, frames, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        finally:
+            conn.execute("PRAGMA busy_timeout = 5000")
+        return {"busy": busy, "wal_frames": frames, "checkpointed": checkpointed}
+
+    def _save_report(self, key: str, report: Dict[str, Any], **values: str):
+        """Stores a report (and any other `meta` values that go with it) for every worker to see."""
+        rows = [(key, json.dumps(report)), *values.items()]
+        self._execute(
+            f"INSERT INTO meta (key, value) VALUES {', '.join('(?, ?)' for _ in rows)} "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            [value for row in rows for value in row]
+        )
+
+    async def run(self, reason: str = "manual", full_vacuum: bool = False) -> Dict[str, Any]:
+        """
+        One maintenance pass: statistics, incremental vacuum, then a checkpoint. Reports what it did.
+        With `full_vacuum` a file that isn't on incremental auto-vacuum yet is first switched over.
+        Raises `MaintenanceBusy` if another worker is running maintenance.
+        """
+        async with self._leased():
+            return await self._run(reason, full_vacuum)
+
+    async def _run(self, reason: str, full_vacuum: bool) -> Dict[str, Any]:
+        start = time.perf_counter()
+        free_before = await asyncio.to_thread(self._free_bytes)
+        wal_before = _file_size(f"{self.db_name}-wal")
+        seq = await asyncio.to_thread(self._item_seq)
+        writes = await asyncio.to_thread(self._item_writes)
+        last_run = await asyncio.to_thread(self._report, "maintenance_last_run")
+        full_analyze = writes >= MAINTENANCE_WRITE_THRESHOLD or last_run is None
+        await asyncio.to_thread(self._analyze, full_analyze)
+
+        switched = full_vacuum and await asyncio.to_thread(self._switch_auto_vacuum)
+        vacuumed = 0
+        while pages := await asyncio.to_thread(self._vacuum_step):
+            vacuumed += pages
+            await asyncio.sleep(MAINTENANCE_PAUSE)
+        free_after = await asyncio.to_thread(self._free_bytes)
+
+        # In WAL mode the file only shrinks once the vacuumed pages are checkpointed.
+        checkpoint = await asyncio.to_thread(self._checkpoint)
+        wal_after = _file_size(f"{self.db_name}-wal")
+        duration = time.perf_counter() - start
+
+        report = {
+            "reason": reason,
+            "finished_at": _now().isoformat(),
+            "item_writes": writes,
+            "analyzed": full_analyze,
+            "auto_vacuum_switched": switched,
+            "pages_vacuumed": vacuumed,
+            "checkpoint": checkpoint,
+            # Free pages handed back to the file system. The WAL is reported on its own, it grows back with writes.
+            "free_bytes_before": free_before,
+            "free_bytes_after": free_after,
+            "bytes_reclaimed": max(free_before - free_after, 0),
+            "wal_bytes_before": wal_before,
+            "wal_bytes_after": wal_after,
+            "wal_bytes_truncated": max(wal_before - wal_after, 0),
+            "duration": round(duration, 3),
+        }
+        # The writes from here on count towards the next pass.
+        await asyncio.to_thread(self._save_report, "maintenance_last_run", report, maintenance_item_seq=str(seq))
+        self.logger.info(
+            f"Database maintenance ({reason}) reclaimed {report['bytes_reclaimed']} bytes "
+            f"({vacuumed} pages vacuumed) and truncated the WAL by {report['wal_bytes_truncated']} bytes "
+            f"in {duration:.2f}s"
+        )
+        return report
+
+
+    def _backup_file(self, source_path: str, dest_path: str):
+        source = sqlite3.connect(source_path, isolation_level=None)
+        try:
+            online_backup(source, dest_path, BACKUP_PAGES, BACKUP_PAUSE)
+        finally:
+            source.close()
+
+    def _prune(self, stem: str):
+        # The timestamp in the name sorts the same way as the time, so the oldest are at the front.
+        for path in sorted(glob.glob(os.path.join(BACKUP_DIR, f"{stem}-*.db")))[:-max(BACKUP_KEEP, 1)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def backup(self) -> Dict[str, Any]:
+        """
+        Takes a consistent online copy of the database (and the order archive) into `BACKUP_DIR`.
+        Raises `MaintenanceBusy` if another worker is running maintenance.
+        """
+        async with self._leased():
+            return await self._backup()
+
+    async def _backup(self) -> Dict[str, Any]:
+        start = time.perf_counter()
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        stamp = _now().strftime("%Y%m%dT%H%M%S%fZ")
+
+        # The main database goes first. An order archived in between is then in both copies, and the archive
+        # cutoff in the main copy keeps reads from counting it twice. The other way round it could be in neither.
+        sources = [self.db_name]
+        if os.path.exists(self.archive_name):
+            sources.append(self.archive_name)
+
+        files: List[Dict[str, Any]] = []
+        for source_path in sources:
+            stem = os.path.splitext(os.path.basename(source_path))[0]
+            dest_path = os.path.join(BACKUP_DIR, f"{stem}-{stamp}.db")
+            await asyncio.to_thread(self._backup_file, source_path, dest_path)
+            files.append({"path": dest_path, "bytes": _file_size(dest_path)})
+            self._prune(stem)
+
+        duration = time.perf_counter() - start
+        report = {"finished_at": _now().isoformat(), "files": files, "duration": round(duration, 3)}
+        await asyncio.to_thread(self._save_report, "maintenance_last_backup", report)
+        self.logger.info(f"Backed up {', '.join(f['path'] for f in files)} in {duration:.2f}s")
+        return report
+
+
+maintenance = MaintenanceScheduler(Logger("maintenance"))
@@ -0,0 +1,319 @@
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+
+import asyncio
+import datetime
+import functools
+import os
+
+try:
+    import asyncpg
+except ImportError:  # Only needed with DATABASE_BACKEND=postgres.
+    asyncpg = None
+
+from database import (
+    APIDatabase,
+    FACET_PRICE_BUCKETS,
+    ITEM_CHANGE_COLUMNS,
+    ITEM_CHANGES_KEEP,
+    _facet_add,
+    _facet_expressions,
+    _facet_rebuild,
+    _facet_remove,
+)
+from logger import Logger
+from tracing import span
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://localhost/api")
+DATABASE_POOL_MIN = int(os.getenv("DATABASE_POOL_MIN", "2"))
+DATABASE_POOL_MAX = int(os.getenv("DATABASE_POOL_MAX", "20"))
+
+# Any constant will do, it only has to be the same for every worker running `create_schema` at the same time.
+SCHEMA_LOCK_ID = 7_362_014
+
+_pool: Optional["asyncpg.Pool"] = None
+_pool_lock = asyncio.Lock()
+
+
+async def get_pool() -> "asyncpg.Pool":
+    """The process wide connection pool, created on first use."""
+    global _pool
+    if _pool is None:
+        if asyncpg is None:
+            raise RuntimeError("DATABASE_BACKEND=postgres needs asyncpg installed (pip install asyncpg)")
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(DATABASE_URL, min_size=DATABASE_POOL_MIN, max_size=DATABASE_POOL_MAX)
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+@functools.lru_cache(maxsize=1024)
+def _placeholders(query: str) -> str:
+    """Turns the shared queries' `?` placeholders into `$1, $2, ...`. None of them has a `?` anywhere else."""
+    parts = query.split("?")
+    return parts[0] + "".join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+
+
+def _rowcount(status: str) -> int:
+    """asyncpg reports a statement as e.g. `UPDATE 3` or `INSERT 0 3`, the last number is the row count."""
+    count = status.rsplit(" ", 1)[-1]
+    return int(count) if count.isdigit() else 0
+
+
+def _facet_triggers() -> List[str]:
+    """The Postgres version of `database._facet_triggers`, one trigger function shared by three triggers."""
+    new, old = _facet_expressions("NEW."), _facet_expressions("OLD.")
+    changed = (
+        "(OLD.quantity > 0) <> (NEW.quantity > 0) OR OLD.brand IS DISTINCT FROM NEW.brand "
+        f"OR OLD.category IS DISTINCT FROM NEW.category OR ({old['price']}) <> ({new['price']})"
+    )
+    return [
+        "CREATE OR REPLACE FUNCTION items_facets() RETURNS trigger AS $$\nBEGIN\n"
+        f"IF TG_OP <> 'INSERT' THEN\n{_facet_remove(old, 'OLD.quantity > 0')}END IF;\n"
+        f"IF TG_OP <> 'DELETE' THEN\n{_facet_add(new, 'NEW.quantity > 0')}END IF;\n"
+        "RETURN NULL;\nEND\n$$ LANGUAGE plpgsql",
+        "CREATE TRIGGER items_facets_insert AFTER INSERT ON items FOR EACH ROW EXECUTE FUNCTION items_facets()",
+        "CREATE TRIGGER items_facets_update AFTER UPDATE OF quantity, price, brand, category ON items "
+        f"FOR EACH ROW WHEN ({changed}) EXECUTE FUNCTION items_facets()",
+        "CREATE TRIGGER items_facets_delete AFTER DELETE ON items FOR EACH ROW EXECUTE FUNCTION items_facets()",
+    ]
+
+
+def _item_change_triggers() -> List[str]:
+    """The Postgres version of `database._item_change_triggers`."""
+    return [
+        "CREATE OR REPLACE FUNCTION items_changes() RETURNS trigger AS $$\nDECLARE new_seq BIGINT;\nBEGIN\n"
+        "INSERT INTO item_changes (item_id) VALUES (CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END) "
+        "RETURNING seq INTO new_seq;\n"
+        # Only the one row that just fell out, a range would have concurrent writers queue up on the same old rows.
+        f"DELETE FROM item_changes WHERE seq = new_seq - {ITEM_CHANGES_KEEP};\n"
+        "RETURN NULL;\nEND\n$$ LANGUAGE plpgsql",
+        "CREATE TRIGGER items_changes_insert AFTER INSERT ON items FOR EACH ROW EXECUTE FUNCTION items_changes()",
+        f"CREATE TRIGGER items_changes_update AFTER UPDATE OF {', '.join(ITEM_CHANGE_COLUMNS)} ON items "
+        "FOR EACH ROW EXECUTE FUNCTION items_changes()",
+        "CREATE TRIGGER items_changes_delete AFTER DELETE ON items FOR EACH ROW EXECUTE FUNCTION items_changes()",
+    ]
+
+
+class PostgresDatabase(APIDatabase):
+    """
+    The PostgreSQL backend, for when a single SQLite writer isn't enough. Each instance borrows one connection from
+    the shared asyncpg pool for as long as it is open.
+
+    Dates stay ISO strings in TEXT columns like on SQLite, so both backends compare and return them the same way.
+    The order archive is the `archive` schema of the same database rather than a second file.
+    """
+
+    # Postgres' LIKE is case sensitive, SQLite's isn't.
+    like = "ILIKE"
+
+    def __init__(self, logger: Logger):
+        super().__init__(logger)
+        self.pool: "asyncpg.Pool"
+        self.conn: "asyncpg.Connection"
+
+    async def __aenter__(self):
+        with span("db"):
+            self.pool = await get_pool()
+            self.conn = await self.pool.acquire()
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        # Releasing resets the connection, a transaction left open by an error is rolled back.
+        await self.pool.release(self.conn)
+
+
+    async def _fetch(self, query: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        with span("db"):
+            rows = await self.conn.fetch(_placeholders(query), *params)
+            return [dict(row) for row in rows]
+
+    async def _fetchrow(self, query: str, params: Sequence[Any] = ()) -> Dict[str, Any] | None:
+        with span("db"):
+            row = await self.conn.fetchrow(_placeholders(query), *params)
+            return dict(row) if row else None
+
+    async def _execute(self, query: str, params: Sequence[Any] = ()) -> int:
+        with span("db"):
+            return _rowcount(await self.conn.execute(_placeholders(query), *params))
+
+    async def _executemany(self, query: str, rows: Sequence[Sequence[Any]]):
+        with span("db"):
+            await self.conn.executemany(_placeholders(query), rows)
+
+    async def _insert(self, query: str, params: Sequence[Any] = ()) -> int:
+        with span("db"):
+            return await self.conn.fetchval(_placeholders(query) + " RETURNING id", *params)
+
+    def _transaction(self):
+        return self.conn.transaction()
+
+    async def _commit(self):
+        # Outside `transaction()` every statement is committed on its own already.
+        pass
+
+
+    async def create_items(self, rows: List[tuple]) -> int:
+        if not rows:
+            return 0
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        columns = [list(column) for column in zip(*rows)]
+        new_rows = await self.conn.fetch(
+            "INSERT INTO items (name, brand, description, category, quantity, price, date_created, date_restocked) "
+            "SELECT name, brand, description, category, quantity, price, $7, $7 "
+            "FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::integer[], $6::double precision[]) "
+            "AS new_item (name, brand, description, category, quantity, price) "
+            "RETURNING id",
+            *columns, now
+        )
+        self.changed_items.update(row["id"] for row in new_rows)
+        return len(new_rows)
+
+    async def restock_items(self, rows: List[tuple]) -> int:
+        if not rows:
+            return 0
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        # One statement for the whole chunk. An item listed twice gets both quantities, like on SQLite.
+        updated = await self.conn.fetch(
+            "UPDATE items SET quantity = items.quantity + restock.quantity, date_restocked = $3 "
+            "FROM (SELECT id, SUM(quantity) AS quantity FROM unnest($1::bigint[], $2::integer[]) AS restocked (id, quantity) "
+            "GROUP BY id) AS restock "
+            "WHERE items.id = restock.id RETURNING items.id",
+            [item_id for item_id, _ in rows], [quantity for _, quantity in rows], now
+        )
+        existing = {row["id"] for row in updated}
+        self.changed_items.update(existing)
+        return sum(1 for item_id, _ in rows if item_id in existing)
+
+
+    async def attach_archive(self, create: bool = False) -> bool:
+        if self.archive_attached:
+            return True
+        if create:
+            await self.conn.execute("""
+            CREATE SCHEMA IF NOT EXISTS archive;
+            CREATE TABLE IF NOT EXISTS archive.orders (
+                id BIGINT PRIMARY KEY,
+                user_id BIGINT NOT NULL,
+                item_id BIGINT NOT NULL,
+                quantity INTEGER NOT NULL,
+                total_price DOUBLE PRECISION NOT NULL,
+                date_ordered TEXT,
+                username TEXT,
+                item_name TEXT,
+                item_brand TEXT,
+                unit_price DOUBLE PRECISION
+            );
+            CREATE INDEX IF NOT EXISTS idx_orders_date ON archive.orders (date_ordered);
+            CREATE INDEX IF NOT EXISTS idx_orders_user_date ON archive.orders (user_id, date_ordered);
+            """)
+        elif not await self.conn.fetchval("SELECT to_regclass('archive.orders') IS NOT NULL"):
+            return False
+        self.archive_attached = True
+        return True
+
+
+    async def create_schema(self):
+        buckets = ",".join(f"{b:g}" for b in FACET_PRICE_BUCKETS)
+
+        async with self.transaction():
+            # Every worker runs this on start, they take turns.
+            await self.conn.execute(f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_ID})")
+            await self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS admins (
+                id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                username TEXT UNIQUE NOT NULL,
+                password_hash TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS items (
+                id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                name TEXT NOT NULL,
+                brand TEXT,
+                description TEXT,
+                category TEXT,
+                quantity INTEGER NOT NULL,
+                price DOUBLE PRECISION NOT NULL,
+                date_created TEXT,
+                date_restocked TEXT
+            );
+            CREATE TABLE IF NOT EXISTS orders (
+                id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                user_id BIGINT NOT NULL REFERENCES users (id),
+                item_id BIGINT NOT NULL REFERENCES items (id),
+                quantity INTEGER NOT NULL,
+                total_price DOUBLE PRECISION NOT NULL,
+                date_ordered TEXT,
+                username TEXT,
+                item_name TEXT,
+                item_brand TEXT,
+                unit_price DOUBLE PRECISION
+            );
+            CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (date_ordered);
+            CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, date_ordered);
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                total INTEGER,
+                processed INTEGER NOT NULL DEFAULT 0,
+                succeeded INTEGER NOT NULL DEFAULT 0,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                date_created TEXT,
+                date_started TEXT,
+                date_finished TEXT,
+                owner TEXT,
+                heartbeat TEXT
+            );
+            ALTER TABLE jobs ADD COLUMN IF NOT EXISTS owner TEXT, ADD COLUMN IF NOT EXISTS heartbeat TEXT;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS item_changes (
+                seq BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+                item_id BIGINT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS facet_counts (
+                category TEXT NOT NULL,
+                facet TEXT NOT NULL,
+                value TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (category, facet, value)
+            );
+            """)
+
+            for kind in ("insert", "update", "delete"):
+                await self.conn.execute(f"DROP TRIGGER IF EXISTS items_facets_{kind} ON items")
+                await self.conn.execute(f"DROP TRIGGER IF EXISTS items_changes_{kind} ON items")
+            for statement in _facet_triggers() + _item_change_triggers():
+                await self.conn.execute(statement)
+            # Also catches rows the triggers skipped, when the one they delete belonged to a rolled back write.
+            await self.conn.execute(
+                "DELETE FROM item_changes WHERE seq <= (SELECT MAX(seq) FROM item_changes) - $1", ITEM_CHANGES_KEEP
+            )
+
+            if await self.get_meta("facet_price_buckets") != buckets:
+                await self.conn.execute("DELETE FROM facet_counts")
+                for statement in _facet_rebuild():
+                    await self.conn.execute(statement)
+                await self.set_meta(facet_price_buckets=buckets)
+                self.logger.info(f"Rebuilt facet counts for price buckets {buckets}")
@@ -0,0 +1,260 @@
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Counter,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+from types import CodeType
+
+from fastapi.responses import JSONResponse
+
+from logger import Logger
+from tracing import server_timing, span, start_trace
+
+# Seconds between samples, 200 a second is plenty to see where time goes and costs next to nothing.
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+# No profile runs longer than this, whether it is timed or waiting for requests.
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# Functions listed in a profile's summary.
+PROFILE_TOP = 30
+
+# Where a thread sits when it is waiting for work rather than doing any. Samples ending in one of these are just counted.
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get")}
+
+
+# Frames are labelled with paths relative to these, the app first (it may live inside a virtualenv).
+_ROOTS = (os.getcwd(), *sys.path, os.path.dirname(os.__file__))
+
+
+def _short_path(path: str) -> str:
+    if "site-packages/" in path:
+        return path.split("site-packages/", 1)[1]
+    for root in _ROOTS:
+        if root and path.startswith(root + os.sep):
+            return path[len(root) + 1:]
+    return path
+
+
+class _Sampler(threading.Thread):
+    """
+    Samples the Python stack of every other thread (the event loop, the SQLite workers, the thread pool) every
+    `interval` seconds, while `active()` says to. Stacks are counted by their frames, so memory grows with the number
+    of distinct stacks and not with the length of the profile.
+    """
+
+    def __init__(self, interval: float, active: Callable[[], bool]):
+        super().__init__(name="profiler", daemon=True)
+        self.interval = interval
+        self.active = active
+        self.stacks: Counter[Tuple[str, ...]] = collections.Counter()
+        self.samples = 0
+        self.idle = 0
+        self.labels: Dict[CodeType, str] = {}
+        self.finished = threading.Event()
+
+    def _label(self, code: CodeType) -> str:
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.finished.wait(self.interval):
+            if not self.active():
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    self.idle += 1
+                    continue
+                stack: List[str] = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def report(self, duration: float) -> Dict[str, Any]:
+        """Flamegraph-ready collapsed stacks (`frame;frame;frame count` per line) and the busiest functions."""
+        busy = sum(self.stacks.values())
+        own: Counter[str] = collections.Counter()
+        total: Counter[str] = collections.Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack[1:]):
+                total[frame] += count
+
+        return {
+            "duration": round(duration, 3),
+            "interval": self.interval,
+            "samples": self.samples,
+            "busy_samples": busy,
+            "idle_samples": self.idle,
+            "top": [
+                {
+                    "function": function,
+                    "self": count,
+                    "total": total[function],
+                    "self_percent": round(count * 100 / busy, 2),
+                    "total_percent": round(total[function] * 100 / busy, 2),
+                }
+                for function, count in own.most_common(PROFILE_TOP)
+            ],
+            "collapsed": "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()),
+        }
+
+
+class SamplingProfiler:
+    """
+    On-demand sampling profiles of this worker process, for `/inventory/profile`. One profile runs at a time.
+
+    A profile either runs for a number of seconds, or until a number of requests whose path starts with a route have
+    finished. In the second case samples are only taken while at least one of those requests is in flight, the
+    middleware below tells the profiler when they start and finish. Every such profile has its own generation, so a
+    request that outlives the profile it was counted in can't throw off the next one's count.
+    """
+
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self.lock = asyncio.Lock()
+        self.route: Optional[str] = None
+        self.wanted = 0
+        self.started = 0
+        self.in_flight = 0
+        self.generation = 0
+        self._done: Optional[asyncio.Event] = None
+
+    async def _capture(self, active: Callable[[], bool], done: Callable[[], Awaitable[Any]]) -> Dict[str, Any]:
+        sampler = _Sampler(PROFILE_INTERVAL, active)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await done()
+        finally:
+            sampler.finished.set()
+            await asyncio.to_thread(sampler.join)
+        return sampler.report(time.perf_counter() - start)
+
+    async def profile_for(self, seconds: float) -> Dict[str, Any]:
+        async with self.lock:
+            report = await self._capture(lambda: True, lambda: asyncio.sleep(min(seconds, PROFILE_MAX_SECONDS)))
+            self.logger.info(f"Profiled {report['duration']}s, {report['samples']} samples")
+            return report
+
+    async def profile_requests(self, route: str, count: int) -> Dict[str, Any]:
+        async with self.lock:
+            self.generation += 1
+            self.route, self.wanted, self.started, self.in_flight = route, count, 0, 0
+            self._done = asyncio.Event()
+            done = self._done
+
+            async def wait():
+                try:
+                    await asyncio.wait_for(done.wait(), PROFILE_MAX_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+            try:
+                report = await self._capture(lambda: self.in_flight > 0, wait)
+            finally:
+                self.route = None
+            report.update(route=route, requests=self.started)
+            self.logger.info(f"Profiled {self.started} requests to {route}, {report['samples']} samples")
+            return report
+
+    def request_started(self, path: str) -> Optional[int]:
+        """
+        If the request is one the current profile is waiting for, that profile's generation, which has to be passed
+        to `request_finished` when it's done. Otherwise None.
+        """
+        if self.route is None or self.started >= self.wanted or not path.startswith(self.route):
+            return None
+        self.started += 1
+        self.in_flight += 1
+        return self.generation
+
+    def request_finished(self, generation: int):
+        if generation != self.generation:
+            # Counted by a profile that has already ended.
+            return
+        self.in_flight -= 1
+        if self.started >= self.wanted and self.in_flight == 0 and self._done is not None:
+            self._done.set()
+
+
+profiler = SamplingProfiler(Logger("profiler"))
+
+
+class TracedJSONResponse(JSONResponse):
+    """The app's default response class, so traced requests see how long rendering their JSON took."""
+
+    def render(self, content: Any) -> bytes:
+        with span("serialization"):
+            return super().render(content)
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that lets requests take part in profiling.
+
+    It reports requests to the running request-count profile, if any. And a request that sends an admin's session
+    token in `X-Trace` gets a `Server-Timing` header with the time it spent per span category (db, hashing,
+    serialization, logging) and in total, up to when its response started.
+    """
+
+    def __init__(self, app: Callable[..., Awaitable[Any]]):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        generation = profiler.request_started(scope["path"])
+        try:
+            if self._wants_trace(scope):
+                await self._traced(scope, receive, send)
+            else:
+                await self.app(scope, receive, send)
+        finally:
+            if generation is not None:
+                profiler.request_finished(generation)
+
+    def _wants_trace(self, scope) -> bool:
+        # Imported here, routes.auth depends on the database module which depends on tracing.
+        from routes.auth import sessions
+
+        for name, value in scope["headers"]:
+            if name == b"x-trace":
+                session = sessions.get(value.decode("latin-1"))
+                return session is not None and session["role"] == "admin"
+        return False
+
+    async def _traced(self, scope, receive, send):
+        trace = start_trace()
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                value = server_timing(trace, time.perf_counter() - start).encode("latin-1")
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", value)]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
@@ -6,7 +6,7 @@ from typing import (
 import datetime
 from fastapi import APIRouter, Depends, Form, HTTPException
 
-from database import APIDatabase, get_db
+from database import APIDatabase, OutOfStockError, get_db
 from routes.auth import sessions
 
 router = APIRouter(prefix="/cart", tags=["cart"])
@@ -88,25 +88,23 @@ async def checkout_cart(
     order_ids = []
     now = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
+    available = []
     for entry in carts[token]:
         item = await db.get_item(entry["item_id"])
         if not item or item["quantity"] < entry["quantity"]:
             continue
+        available.append((item, entry["quantity"]))
+
+    # All of the cart's orders are placed together, or none of them.
+    async with db.transaction():
+        for item, quantity in available:
+            try:
+                order_id = await db.place_order(user_id, session["username"], item, quantity, now)
+            except OutOfStockError:
+                # Sold out since it was read above, skipped like any other unavailable item.
+                continue
+            order_ids.append(order_id)
 
-        total_price = item["price"] * entry["quantity"]
-        await db.conn.execute(
-            "INSERT INTO orders (user_id, item_id, quantity, total_price, date_ordered) VALUES (?, ?, ?, ?, ?)",
-            (user_id, item["id"], entry["quantity"], total_price, now)
-        )
-        await db.conn.execute(
-            "UPDATE items SET quantity = quantity - ? WHERE id = ?",
-            (entry["quantity"], item["id"])
-        )
-        cur = await db.conn.execute("SELECT last_insert_rowid() AS order_id")
-        row = await cur.fetchone()
-        order_ids.append(row["order_id"])
-
-    await db.conn.commit()
     carts[token] = []  # I'm assuming no one wants to keep the old cart after buying the stuff
 
     return {"msg": f"Checkout complete, orders placed", "order_ids": order_ids}
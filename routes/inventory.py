@@ -1,8 +1,15 @@
-import csv
-from fastapi import APIRouter, Depends, Form, HTTPException, UploadFile, Header
+from fastapi import APIRouter, Depends, Form, HTTPException, UploadFile, Header, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
 from routes.auth import sessions
-from database import APIDatabase, get_db
+from routes.orders import parse_date_range
+from analytics import get_report_db
+from archive import ORDER_ARCHIVE_AGE_DAYS, order_archiver
+from database import DATABASE_BACKEND, APIDatabase, get_db
+from feed import ADMIN_FIELDS, change_feed, parse_last_event_id
+from jobs import job_runner
+from maintenance import MaintenanceBusy, maintenance
+from profiler import PROFILE_MAX_SECONDS, profiler
 
 router = APIRouter(prefix="/inventory", tags=["inventory"])
 
@@ -17,15 +24,32 @@ def require_admin(authorization: str = Header(...)):
 
 
 @router.get("/list")
-async def list_items(admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
+async def list_items(admin=Depends(require_admin), db: APIDatabase = Depends(get_report_db)):
     try:
-        items = await db.list_items()
-        print(items)  # debug: see what fields are actually returned
-        return items
+        return await db.list_items()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to list items: {str(e)}")
 
 
+@router.get("/changes")
+async def inventory_changes(
+    request: Request,
+    since: int | None = Query(None, description="Resume after this event id"),
+    last_event_id: str | None = Header(None),
+    admin=Depends(require_admin)
+):
+    """
+    A Server-Sent Events stream of every item change, for dashboards that would otherwise poll `/inventory/list`.
+    Each `item` event carries `seq`, `item_id`, `name`, `price`, `quantity` and `in_stock`.
+    A `reset` event means events were missed and the dashboard should reload the full list.
+    """
+    return StreamingResponse(
+        change_feed.stream(request, parse_last_event_id(since, last_event_id), ADMIN_FIELDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
 @router.post("/new")
 async def create_item(
     name: str = Form(...),
@@ -52,10 +76,12 @@ async def create_item(
         raise HTTPException(status_code=500, detail=f"Failed to create item: {str(e)}")
 
 
-@router.post("/bulk_new")
+@router.post("/bulk_new", status_code=202)
 async def bulk_create_items(file: UploadFile, admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
     """
-    This bulk adds new items from a CSV file, with the format `name, brand, description, category, quantity, price` in the CSV file
+    This bulk adds new items from a CSV file, with the format `name, brand, description, category, quantity, price` in the CSV file.
+
+    The file is processed in the background, poll `/inventory/jobs/{job_id}` with the returned job id for progress.
     """
     if file.filename is None:
         raise HTTPException(status_code=400, detail="Add the CSV file with the new item data.")
@@ -64,29 +90,8 @@ async def bulk_create_items(file: UploadFile, admin=Depends(require_admin), db:
     if not file.filename.endswith(".csv"): 
         raise HTTPException(status_code=400, detail="File must be CSV")
 
-    content = await file.read()
-    decoded = content.decode("utf-8").splitlines()
-    reader = csv.DictReader(decoded)
-
-    created_count = 0
-    for row in reader:
-        try:
-            name = row["name"]
-            brand = row.get("brand", "")
-            description = row.get("description", "")
-            category = row.get("category", "")
-            quantity = int(row["quantity"])
-            price = float(row["price"])
-
-            if quantity < 0 or price < 0:
-                continue  # skip invalid rows
-
-            await db.create_item(name, brand, description, category, quantity, price)
-            created_count += 1
-        except Exception:
-            continue  # skip malformed rows
-
-    return {"msg": f"Bulk create complete. {created_count} items added."}
+    job_id = await job_runner.submit(db, "bulk_new", file)
+    return {"msg": "Bulk create queued", "job_id": job_id}
 
 
 @router.post("/update")
@@ -147,10 +152,12 @@ async def restock_item(
         raise HTTPException(status_code=500, detail=f"Failed to restock item: {str(e)}")
 
 
-@router.post("/bulk_restock")
+@router.post("/bulk_restock", status_code=202)
 async def bulk_restock_items(file: UploadFile, admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
     """
     Bulk restocks the items in the inventory from a CSV file, with the format `item_id,quantity` in the CSV file.
+
+    The file is processed in the background, poll `/inventory/jobs/{job_id}` with the returned job id for progress.
     """
     if file.filename is None:
         raise HTTPException(status_code=400, detail="Add the CSV file with the new item data.")
@@ -159,50 +166,177 @@ async def bulk_restock_items(file: UploadFile, admin=Depends(require_admin), db:
     if not file.filename.endswith(".csv"):
         raise HTTPException(status_code=400, detail="File must be CSV")
 
-    content = await file.read()
-    decoded = content.decode("utf-8").splitlines()
-    reader = csv.DictReader(decoded)
+    job_id = await job_runner.submit(db, "bulk_restock", file)
+    return {"msg": "Bulk restock queued", "job_id": job_id}
+
+
+@router.get("/jobs")
+async def list_jobs(admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
+    """Returns every bulk job, oldest first."""
+    return await db.list_jobs()
 
-    restocked_count = 0
-    skipped = 0
-    for row in reader:
-        try:
-            item_id = int(row["item_id"])
-            quantity = int(row["quantity"])
 
-            if quantity <= 0:
-                skipped += 1
-                continue
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str, admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
+    """Returns the full record of a bulk job."""
+    job = await db.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
-            item = await db.get_item(item_id)
-            if not item:
-                skipped += 1
-                continue
 
-            await db.restock_item(item_id, quantity)
-            restocked_count += 1
-        except Exception:
-            skipped += 1
+@router.get("/jobs/{job_id}/progress")
+async def job_progress(job_id: str, admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
+    """Returns just enough of a bulk job to draw a progress bar."""
+    job = await db.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
 
-    return {"msg": f"Bulk restock complete. {restocked_count} items restocked, {skipped} skipped."}
+    percent = 0.0
+    if job["status"] == "completed":
+        percent = 100.0
+    elif job["total"]:
+        percent = round(job["processed"] * 100 / job["total"], 2)
+
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "processed": job["processed"],
+        "total": job["total"],
+        "percent": percent
+    }
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
+    """Cancels a bulk job. Rows from chunks that already finished stay applied."""
+    job = await db.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    status = await job_runner.cancel(db, job)
+    return {"job_id": job_id, "status": status}
 
 
 @router.get("/orders")
-async def view_orders(admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
-    """Returns all the orders that have been placed."""
+async def view_orders(
+    since: str | None = Query(None, description="Only orders placed at or after this ISO date"),
+    until: str | None = Query(None, description="Only orders placed before this ISO date"),
+    admin=Depends(require_admin),
+    db: APIDatabase = Depends(get_report_db)
+):
+    """
+    Returns the orders that have been placed, all of them unless `since`/`until` narrow it down.
+    This is a report, see the `X-Snapshot-Age` header for how stale it may be.
+    """
+    since, until = parse_date_range(since, until)
     try:
-        return await db.get_orders()
+        return await db.get_orders(since=since, until=until)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch orders: {str(e)}")
 
 
 @router.get("/revenue")
-async def total_revenue(admin=Depends(require_admin), db: APIDatabase = Depends(get_db)):
-    """Returns the total revenue generated."""
+async def total_revenue(admin=Depends(require_admin), db: APIDatabase = Depends(get_report_db)):
+    """
+    Returns the total revenue generated.
+    This is a report, see the `X-Snapshot-Age` header for how stale it may be.
+    """
     try:
         revenue = await db.get_revenue()
         return {"total_revenue": revenue}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to calculate revenue: {str(e)}")
-    
 
+
+@router.post("/archive")
+async def archive_orders(age_days: float | None = Form(None), admin=Depends(require_admin)):
+    """
+    Moves orders older than `age_days` days (by default `ORDER_ARCHIVE_AGE_DAYS`) to the archive database right now.
+    """
+    if age_days is None:
+        if not ORDER_ARCHIVE_AGE_DAYS:
+            raise HTTPException(status_code=400, detail="Pass age_days, no default archive age is configured")
+        age_days = float(ORDER_ARCHIVE_AGE_DAYS)
+    if age_days < 0:
+        raise HTTPException(status_code=400, detail="age_days cannot be negative")
+
+    try:
+        return await order_archiver.run(age_days)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to archive orders: {str(e)}")
+
+
+def require_sqlite():
+    if DATABASE_BACKEND != "sqlite":
+        raise HTTPException(status_code=400, detail="Database maintenance is only needed on the sqlite backend")
+
+
+@router.get("/maintenance")
+async def maintenance_status(admin=Depends(require_admin)):
+    """Returns the report of the last maintenance pass and the last backup, and the item writes since that pass."""
+    return await maintenance.status()
+
+
+@router.post("/maintenance")
+async def run_maintenance(
+    full_vacuum: bool = Form(False), admin=Depends(require_admin), sqlite=Depends(require_sqlite)
+):
+    """
+    Runs a maintenance pass right now: refreshes the planner statistics, gives free pages back to the file system and
+    checkpoints the WAL. Returns its duration, the bytes of free pages it reclaimed and how far the WAL was truncated.
+
+    Free pages can only be given back once the file uses incremental auto-vacuum, which new files do. An older file
+    is switched over with `full_vacuum=true`, a one-off full VACUUM that blocks writes while it rewrites the file.
+    """
+    try:
+        return await maintenance.run(full_vacuum=full_vacuum)
+    except MaintenanceBusy:
+        raise HTTPException(status_code=409, detail="Another worker is running database maintenance")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to run database maintenance: {str(e)}")
+
+
+@router.post("/backup")
+async def backup_database(admin=Depends(require_admin), sqlite=Depends(require_sqlite)):
+    """Takes an online backup of the database (and the order archive) into `BACKUP_DIR` right now."""
+    try:
+        return await maintenance.backup()
+    except MaintenanceBusy:
+        raise HTTPException(status_code=409, detail="Another worker is running database maintenance")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to back up the database: {str(e)}")
+
+
+@router.post("/profile")
+async def profile(
+    seconds: float | None = Form(None),
+    requests: int | None = Form(None),
+    route: str = Form("/"),
+    format: str = Form("json"),
+    admin=Depends(require_admin),
+):
+    """
+    Samples the stacks of this worker process, either for `seconds` or over the next `requests` requests whose path
+    starts with `route`, and returns the busiest functions with the collapsed stacks. With `format=collapsed` only
+    the collapsed stacks are returned, ready for flamegraph.pl or speedscope. With several workers, only the one
+    that handles this request is profiled.
+    """
+    if (seconds is None) == (requests is None):
+        raise HTTPException(status_code=400, detail="Pass either seconds or requests")
+    if format not in ("json", "collapsed"):
+        raise HTTPException(status_code=400, detail="format must be json or collapsed")
+    if seconds is not None and not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS:g}")
+    if requests is not None and requests < 1:
+        raise HTTPException(status_code=400, detail="requests must be at least 1")
+    if profiler.lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+
+    if seconds is not None:
+        report = await profiler.profile_for(seconds)
+    else:
+        report = await profiler.profile_requests(route, requests)
+    if format == "collapsed":
+        return PlainTextResponse(report["collapsed"])
+    return report
@@ -1,23 +1,55 @@
 
 import datetime
-from fastapi import APIRouter, Depends, HTTPException, Form
+from fastapi import APIRouter, Depends, HTTPException, Form, Query
 
-from database import APIDatabase, get_db
+from database import APIDatabase, OutOfStockError, get_db
 from routes.auth import sessions
 
 
 router = APIRouter(prefix="/orders", tags=["orders"])
 
+
+def parse_date(value: str | None, name: str) -> str | None:
+    """
+    Turns a `since`/`until` query parameter into the UTC ISO format orders are stored with, so they compare as strings.
+    Dates without a timezone are taken as UTC.
+    """
+    if value is None:
+        return None
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an ISO date, like 2025-01-31 or 2025-01-31T12:00:00")
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.astimezone(datetime.timezone.utc).isoformat()
+
+
+def parse_date_range(since: str | None, until: str | None) -> tuple:
+    """`parse_date` for both ends of a `[since, until)` range, which must not end before it starts."""
+    since, until = parse_date(since, "since"), parse_date(until, "until")
+    if since is not None and until is not None and since > until:
+        raise HTTPException(status_code=400, detail="since must not be after until")
+    return since, until
+
+
 @router.get("/past")
-async def past_orders(token: str = Form(...), db: APIDatabase = Depends(get_db)):
-    """Gets all the past orders of the logged in user."""
+async def past_orders(
+    token: str = Form(...),
+    since: str | None = Query(None, description="Only orders placed at or after this ISO date"),
+    until: str | None = Query(None, description="Only orders placed before this ISO date"),
+    db: APIDatabase = Depends(get_db)
+):
+    """
+    Gets the past orders of the logged in user. Asking only for recent orders (with `since`) keeps the archive out of it.
+    """
     session = sessions.get(token)
     if not session:
         raise HTTPException(status_code=401, detail="Invalid token")
     user_id = session["user_id"]
 
-    all_orders = await db.get_orders()
-    user_orders = [o for o in all_orders if o["user_id"] == user_id]
+    since, until = parse_date_range(since, until)
+    user_orders = await db.get_orders(user_id, since, until)
     return {"orders": user_orders}
 
 @router.post("/new")
@@ -39,19 +71,13 @@ async def make_order(
     if item["quantity"] < quantity:
         raise HTTPException(status_code=400, detail="Not enough stock")
 
-    total_price = item["price"] * quantity
     now = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
-    await db.conn.execute(
-        "INSERT INTO orders (user_id, item_id, quantity, total_price, date_ordered) VALUES (?, ?, ?, ?, ?)",
-        (user_id, item_id, quantity, total_price, now)
-    )
-    await db.conn.execute(
-        "UPDATE items SET quantity = quantity - ? WHERE id = ?",
-        (quantity, item_id)
-    )
-    await db.conn.commit()
-
-    cur = await db.conn.execute("SELECT last_insert_rowid() AS order_id")
-    row = await cur.fetchone()
-    return {"order_id": row["order_id"]}
+    try:
+        async with db.transaction():
+            order_id = await db.place_order(user_id, session["username"], item, quantity, now)
+    except OutOfStockError:
+        # Someone else bought it in the meantime.
+        raise HTTPException(status_code=400, detail="Not enough stock")
+
+    return {"order_id": order_id}
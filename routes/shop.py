@@ -1,6 +1,9 @@
-from fastapi import APIRouter, Query, Depends, HTTPException, Path
+from fastapi import APIRouter, Query, Depends, HTTPException, Path, Request, Header
+from fastapi.responses import StreamingResponse
 
+from catalog import catalog_index
 from database import APIDatabase, get_db
+from feed import PUBLIC_FIELDS, change_feed, parse_last_event_id
 
 router = APIRouter(prefix="/shop", tags=["shop"])
 
@@ -23,39 +26,59 @@ async def list_items(
     - search: keyword search in name or description
     - pagination: limit and offset
     - sorting: sort_by ('name' or 'price') and sort_order ('asc' or 'desc')
-    """
-    query = "SELECT id, name, brand, description, category, price, quantity FROM items WHERE quantity > 0"
-    params = []
-
-    if category:
-        query += " AND category = ?"
-        params.append(category)
 
+    With `CATALOG_ENGINE=columnar` this is answered from the in-memory catalog index instead of SQLite.
+    """
+    min_price = max_price = None
     if price:
         try:
             min_price, max_price = map(float, price.split("-"))
-            query += " AND price BETWEEN ? AND ?"
-            params.extend([min_price, max_price])
         except Exception:
             raise HTTPException(status_code=400, detail="Price range format should be min-max")
 
-    if search:
-        search_term = f"%{search}%"
-        query += " AND (name LIKE ? OR description LIKE ?)"
-        params.extend([search_term, search_term])
+    try:
+        if catalog_index is not None:
+            return await catalog_index.search_items(
+                db, category, min_price, max_price, search, limit, offset, sort_by, sort_order
+            )
+        return await db.search_items(category, min_price, max_price, search, limit, offset, sort_by, sort_order)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch items: {str(e)}")
 
-    query += f" ORDER BY {sort_by} {sort_order.upper()}"
 
-    query += " LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
 
+@router.get("/facets")
+async def get_facets(
+    db: APIDatabase = Depends(get_db),
+    category: str | None = Query(None, description="Only count items in this category"),
+    search: str | None = Query(None, description="Only count items matching this search in name or description"),
+):
+    """
+    Get the number of in-stock items per category, brand and price bucket, for the same
+    `category` and `search` filters as `/shop/list`. Price buckets look like "500-1000" and the last one like "5000+".
+    """
     try:
-        cur = await db.conn.execute(query, tuple(params))
-        rows = await cur.fetchall()
-        return [dict(row) for row in rows]
+        return await db.get_facets(category, search)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to fetch items: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to fetch facets: {str(e)}")
+
 
+@router.get("/changes")
+async def item_changes(
+    request: Request,
+    since: int | None = Query(None, description="Resume after this event id"),
+    last_event_id: str | None = Header(None),
+):
+    """
+    A Server-Sent Events stream of price and stock changes, so storefront caches don't need to poll `/shop/item/{id}`.
+    Each `item` event carries `seq`, `item_id`, `price` and `in_stock`. A `reset` event means events were missed
+    and anything cached should be refetched.
+    """
+    return StreamingResponse(
+        change_feed.stream(request, parse_last_event_id(since, last_event_id), PUBLIC_FIELDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
 
 
 @router.get("/item/{item_id}")
@@ -85,9 +108,6 @@ async def get_categories(db: APIDatabase = Depends(get_db)):
     Get a list of all unique categories in the shop.
     """
     try:
-        cur = await db.conn.execute("SELECT DISTINCT category FROM items WHERE quantity > 0")
-        rows = await cur.fetchall()
-        categories = [row["category"] for row in rows if row["category"]]
-        return {"categories": categories}
+        return {"categories": await db.get_categories()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch categories: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,83 @@
+import os
+import sys
+from urllib.parse import urlsplit, urlunsplit
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import jobs  # noqa: E402
+from logger import Logger  # noqa: E402
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def _test_database_url() -> str:
+    """`DATABASE_URL` pointed at an `api_test` database next to it, the tests wipe it before every test."""
+    import postgres
+
+    url = urlsplit(os.getenv("TEST_DATABASE_URL", postgres.DATABASE_URL))
+    if "TEST_DATABASE_URL" in os.environ:
+        return urlunsplit(url)
+    return urlunsplit(url._replace(path="/api_test"))
+
+
+async def _reset_postgres(url: str):
+    if asyncpg is None:
+        pytest.skip("asyncpg is not installed")
+    try:
+        conn = await asyncpg.connect(url, timeout=5)
+    except asyncpg.InvalidCatalogNameError:
+        try:
+            admin = await asyncpg.connect(urlunsplit(urlsplit(url)._replace(path="/postgres")), timeout=5)
+            try:
+                await admin.execute(f'CREATE DATABASE "{urlsplit(url).path.lstrip("/")}"')
+            finally:
+                await admin.close()
+        except asyncpg.PostgresError as e:
+            pytest.skip(f"Can't create the Postgres test database: {e}")
+        conn = await asyncpg.connect(url, timeout=5)
+    except (OSError, asyncpg.PostgresError) as e:
+        pytest.skip(f"Postgres is not reachable: {e}")
+
+    try:
+        await conn.execute("DROP SCHEMA IF EXISTS archive CASCADE; DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+async def backend(request, tmp_path, monkeypatch):
+    """Runs the test against each storage backend, on a fresh empty database with the schema created."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, "DATABASE_BACKEND", request.param)
+    monkeypatch.setattr(jobs, "UPLOADS_DIR", str(tmp_path / "uploads"))
+
+    if request.param == "postgres":
+        import postgres
+
+        url = _test_database_url()
+        await _reset_postgres(url)
+        monkeypatch.setattr(postgres, "DATABASE_URL", url)
+    else:
+        monkeypatch.setenv("DATABASE_NAME", str(tmp_path / "api_data.db"))
+        monkeypatch.setenv("ARCHIVE_DATABASE_NAME", str(tmp_path / "api_archive.db"))
+
+    await database.init_db()
+    yield request.param
+    await database.close_db()
+
+
+@pytest.fixture
+async def db(backend):
+    async with database.open_db(Logger("tests")) as db:
+        yield db
@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+import catalog  # noqa: E402
+from catalog import CatalogIndex  # noqa: E402
+from logger import Logger  # noqa: E402
+
+pytestmark = pytest.mark.anyio
+
+# Names and prices are unique, so neither engine has ties to order its own way.
+QUERIES = [
+    {},
+    {"sort_by": "name", "sort_order": "desc", "limit": 7, "offset": 3},
+    {"category": "office", "sort_by": "price"},
+    {"min_price": 20, "max_price": 60, "sort_by": "price", "sort_order": "desc"},
+    {"search": "LAMP"},
+    {"search": "oak", "sort_by": "price", "offset": 2, "limit": 4},
+    {"search": "zzz"},
+    {"search": "a_e"},
+    {"search": "l%p", "category": "home"},
+    {"search": "%"},
+]
+
+
+async def assert_same(db, index):
+    for kwargs in QUERIES:
+        assert await index.search_items(db, **kwargs) == await db.search_items(**kwargs), kwargs
+
+
+async def test_columnar_matches_sql_after_updates(db, monkeypatch):
+    # Small enough that the tests go through the full scan, the rows checked one by one and the rejoin.
+    monkeypatch.setattr(catalog, "SEARCH_WALK_ROWS", 5)
+    monkeypatch.setattr(catalog, "SEARCH_REBUILD_ROWS", 3)
+    words = ["lamp", "desk", "sofa", "chair"]
+    descriptions = ["red oak", "blue lamp shade", "", "oak table"]
+    await db.create_items([
+        (f"{words[i % 4]}{i:03d}", "acme", descriptions[i % 3], ["home", "office"][i % 2], i % 5, 10 + i * 1.25)
+        for i in range(60)
+    ])
+    await db.commit()
+    ids = [row["id"] for row in await db._fetch("SELECT id FROM items ORDER BY id")]
+
+    index = CatalogIndex(Logger("tests"))
+    await assert_same(db, index)
+
+    await db.update_item(ids[3], name="zzz lamp", price=99.5)
+    await db.update_item(ids[1], quantity=0)
+    await assert_same(db, index)
+
+    await db.update_item(ids[2], description="plain", category="office")
+    await db.restock_item(ids[5], 3)
+    await db.update_item(ids[6], name="aardvark", description="hat")
+    await db.create_items([("cable", "acme", "long lamp cord", "office", 4, 7.75)])
+    await db.commit()
+    await db.update_item(ids[7], price=0.5)
+    await assert_same(db, index)
+    assert not index.search_stale
@@ -0,0 +1,219 @@
+import asyncio
+import os
+
+import pytest
+
+from archive import order_archiver
+from database import OutOfStockError, open_db
+from jobs import JobRunner
+from logger import Logger
+
+pytestmark = pytest.mark.anyio
+
+
+async def add_item(db, name="Lamp", brand="Acme", description="A desk lamp", category="home", quantity=10, price=25.0):
+    await db.create_item(name, brand, description, category, quantity, price)
+    return (await db._fetchrow("SELECT MAX(id) AS id FROM items"))["id"]
+
+
+async def add_user(db, username="alice"):
+    await db.create_user(username, "hash")
+    return (await db.get_user(username))["id"]
+
+
+async def test_create_update_restock(db):
+    item_id = await add_item(db)
+
+    await db.update_item(item_id, name="Desk lamp", price=30.0)
+    await db.restock_item(item_id, 5)
+
+    item = await db.get_item(item_id)
+    assert item["name"] == "Desk lamp"
+    assert item["price"] == 30.0
+    assert item["quantity"] == 15
+    assert item["date_restocked"] >= item["date_created"]
+
+
+async def test_bulk_writes(db):
+    created = await db.create_items([
+        ("Pen", "Bic", "Blue pen", "office", 100, 1.5),
+        ("Pad", "Rhodia", "Dot pad", "office", 20, 8.0),
+    ])
+    assert created == 2
+
+    ids = [row["id"] for row in await db._fetch("SELECT id FROM items ORDER BY id")]
+    # The same item twice gets both quantities, an unknown item is skipped.
+    restocked = await db.restock_items([(ids[0], 5), (ids[0], 5), (ids[1], 1), (ids[1] + 1000, 3)])
+    await db.commit()
+    assert restocked == 3
+    assert [row["quantity"] for row in await db._fetch("SELECT quantity FROM items ORDER BY id")] == [110, 21]
+
+
+async def test_bulk_job_runs_once_across_runners(db, tmp_path):
+    item_id = await add_item(db, quantity=0)
+    path = tmp_path / "restock.csv"
+    path.write_text("item_id,quantity\n" + f"{item_id},1\n" * 100 + "oops,1\n")
+    await db.create_job("job1", "bulk_restock", str(path))
+
+    runners = [JobRunner(Logger("tests"), chunk_size=10) for _ in range(2)]
+
+    async def run(runner):
+        async with open_db(runner.logger) as runner_db:
+            await runner._run(runner_db, "job1")
+
+    await asyncio.gather(*(run(runner) for runner in runners))
+
+    job = await db.get_job("job1")
+    assert job["status"] == "completed"
+    assert (job["total"], job["processed"], job["succeeded"], job["skipped"]) == (101, 101, 100, 1)
+    assert job["owner"] in {runner.owner for runner in runners}
+    assert (await db.get_item(item_id))["quantity"] == 100
+    assert not os.path.exists(path)
+
+
+async def test_job_claim_and_cancel(db, tmp_path):
+    path = tmp_path / "new.csv"
+    path.write_text("name,brand,description,category,quantity,price\nPen,Bic,Blue,office,1,2\n")
+    await db.create_job("job2", "bulk_new", str(path))
+
+    assert await db.claim_job("job2", "runner-a", "2000-01-01")
+    assert not await db.claim_job("job2", "runner-b", "2000-01-01")
+    # A cancel from anywhere marks it, and the runner's next guarded update then fails.
+    assert await JobRunner(Logger("tests")).cancel(db, await db.get_job("job2")) == "cancelling"
+    assert not await db.update_job("job2", if_status=("running",), if_owner="runner-a", processed=1)
+
+    # A runner that stops hands its running jobs back to the queue.
+    await db.create_job("job3", "bulk_new", str(path))
+    assert await db.claim_job("job3", "runner-a", "2000-01-01")
+    assert await db.release_jobs("runner-a") == 1
+    assert (await db.get_job("job3"))["status"] == "queued"
+    assert await db.claim_job("job3", "runner-b", "2000-01-01")
+
+
+async def test_place_order(db):
+    user_id = await add_user(db)
+    item_id = await add_item(db, quantity=3, price=10.0)
+    item = await db.get_item(item_id)
+
+    async with db.transaction():
+        order_id = await db.place_order(user_id, "alice", item, 2, "2026-01-01T00:00:00+00:00")
+    assert (await db.get_item(item_id))["quantity"] == 1
+
+    with pytest.raises(OutOfStockError):
+        async with db.transaction():
+            await db.place_order(user_id, "alice", item, 2, "2026-01-01T00:00:00+00:00")
+    assert (await db.get_item(item_id))["quantity"] == 1
+
+    orders = await db.get_orders(user_id=user_id)
+    assert [(o["order_id"], o["item_name"], o["quantity"], o["total_price"]) for o in orders] == [
+        (order_id, "Lamp", 2, 20.0)
+    ]
+
+
+async def test_checkout_is_atomic(db):
+    user_id = await add_user(db)
+    plenty = await db.get_item(await add_item(db, name="Pen", quantity=10))
+    scarce = await db.get_item(await add_item(db, name="Ink", quantity=1))
+
+    with pytest.raises(OutOfStockError):
+        async with db.transaction():
+            await db.place_order(user_id, "alice", plenty, 5, "2026-01-01T00:00:00+00:00")
+            await db.place_order(user_id, "alice", scarce, 2, "2026-01-01T00:00:00+00:00")
+
+    # The first order was rolled back with the second.
+    assert (await db.get_item(plenty["id"]))["quantity"] == 10
+    assert (await db.get_item(scarce["id"]))["quantity"] == 1
+    assert await db.get_orders() == []
+    assert not db.changed_items
+
+
+async def test_concurrent_orders_do_not_oversell(db, backend):
+    user_id = await add_user(db)
+    item = await db.get_item(await add_item(db, quantity=5))
+
+    async def order():
+        async with open_db(Logger("tests")) as order_db:
+            try:
+                async with order_db.transaction():
+                    await order_db.place_order(user_id, "alice", item, 1, "2026-01-01T00:00:00+00:00")
+                return True
+            except OutOfStockError:
+                return False
+
+    placed = await asyncio.gather(*(order() for _ in range(20)))
+    assert sum(placed) == 5
+    assert (await db.get_item(item["id"]))["quantity"] == 0
+
+
+async def test_facets(db):
+    await db.create_items([
+        ("Lamp", "Acme", "Desk lamp", "home", 3, 25.0),
+        ("Sofa", "Acme", "Big sofa", "home", 1, 1500.0),
+        ("Chair", "Ikea", "Office chair", "office", 0, 80.0),
+        ("Desk", "Ikea", "Standing desk", "office", 2, 700.0),
+    ])
+    await db.commit()
+
+    facets = await db.get_facets()
+    assert facets["category"] == {"home": 2, "office": 1}
+    assert facets["brand"] == {"Acme": 2, "Ikea": 1}
+    assert facets["price"] == {"0-500": 1, "500-1000": 1, "1000-2000": 1}
+
+    assert (await db.get_facets(category="home"))["brand"] == {"Acme": 2}
+    assert (await db.get_facets(search="DESK"))["category"] == {"home": 1, "office": 1}
+
+    # The trigger-kept counts follow stock going to zero and coming back.
+    chair = (await db._fetchrow("SELECT id FROM items WHERE name = 'Chair'"))["id"]
+    await db.restock_item(chair, 4)
+    await db.update_item((await db._fetchrow("SELECT id FROM items WHERE name = 'Sofa'"))["id"], quantity=0)
+    facets = await db.get_facets()
+    assert facets["category"] == {"home": 1, "office": 2}
+    assert facets["price"] == {"0-500": 2, "500-1000": 1}
+
+
+async def test_search(db):
+    await db.create_items([
+        ("Red Lamp", "Acme", "Bright light", "home", 3, 25.0),
+        ("Blue lamp", "Acme", "Soft light", "home", 3, 15.0),
+        ("Rug", "Ikea", "Red and lamp-free", "home", 3, 40.0),
+        ("Old lamp", "Acme", "Sold out", "home", 0, 5.0),
+        ("Pen", "Bic", "Writes", "office", 3, 1.0),
+    ])
+    await db.commit()
+
+    # Case insensitive, over name and description, in stock only.
+    found = await db.search_items(search="LAMP", sort_by="price", sort_order="asc")
+    assert [item["name"] for item in found] == ["Blue lamp", "Red Lamp", "Rug"]
+
+    found = await db.search_items(category="home", min_price=20, max_price=50, sort_by="name", sort_order="desc")
+    assert [item["name"] for item in found] == ["Rug", "Red Lamp"]
+
+    found = await db.search_items(sort_by="name", sort_order="asc", limit=2, offset=1)
+    assert [item["name"] for item in found] == ["Pen", "Red Lamp"]
+
+
+async def test_archive_keeps_orders_and_revenue(db):
+    user_id = await add_user(db)
+    item = await db.get_item(await add_item(db, quantity=10, price=10.0))
+    dates = ["2020-01-01T00:00:00+00:00", "2020-06-01T00:00:00+00:00", "2099-01-01T00:00:00+00:00"]
+    async with db.transaction():
+        for quantity, date in enumerate(dates, 1):
+            await db.place_order(user_id, "alice", item, quantity, date)
+
+    before = await db.get_orders()
+    assert await db.get_revenue() == 60.0
+
+    report = await order_archiver.run(365)
+    assert (report["copied"], report["deleted"]) == (2, 2)
+    # Running it again has nothing left to move.
+    assert (await order_archiver.run(365))["copied"] == 0
+
+    async with open_db(Logger("tests")) as reader:
+        assert await reader.get_orders() == before
+        assert await reader.get_revenue() == 60.0
+        assert [o["date_ordered"] for o in await reader.get_orders(since="2020-03-01", until="2021-01-01")] == [dates[1]]
+        assert len(await reader.get_orders(since="2098-01-01")) == 1
+        assert (await reader._fetchrow("SELECT COUNT(*) AS count FROM orders"))["count"] == 1
+        # A range on neither side of the cutoff reads no table at all.
+        cutoff = await reader.get_meta("orders_archived_before")
+        assert await reader.get_orders(since=cutoff, until=cutoff) == []